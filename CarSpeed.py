@@ -1,4 +1,5 @@
-from CarSpeedMonitor import CarSpeedMonitor, DetectionResult
+from CarSpeedMonitor import CarSpeedCamera, CarSpeedMonitor, DetectionResult
+from CarSpeedReplay import open_replay_source
 from CarSpeedConfig import CarSpeedConfig
 from datetime import date
 from datetime import datetime
@@ -81,9 +82,15 @@ def car_detected(data: DetectionResult):
 ap = argparse.ArgumentParser(description="Monitors car speed using raspberry pi camera")
 ap.add_argument("--file","-f", default=CarSpeedConfig.DEF_CONFIG_FILE, help="Filename to store config")
 ap.add_argument("--preview","-p", action='store_true', help="Create preview window")
+ap.add_argument("--replay","-r", help="Replay a video file, folder of jpgs, detection zip or folder of zips instead of using the camera")
+ap.add_argument("--realtime", action='store_true', help="Replay at the recorded speed rather than as fast as possible")
+ap.add_argument("--fps", type=float, default=CarSpeedCamera.FRAME_RATE, help="Frame rate to replay frames without timestamps at")
 args = vars(ap.parse_args())
 
 show_preview = args["preview"]
+frame_source = None
+if args["replay"]:
+    frame_source = open_replay_source(args["replay"],args["fps"],args["realtime"])
 
 csvWriter = CsvWriter()
 detectionSaver = DetectionSaver()
@@ -93,7 +100,7 @@ config = CarSpeedConfig.fromDefJsonFile()
 
 # start the monitor
 if config!=None:
-    proc = CarSpeedMonitor(config)
+    proc = CarSpeedMonitor(config,frame_source)
     proc.start(detection_hook=car_detected,show_preview=show_preview)
 
 
@@ -0,0 +1,126 @@
+from typing import Dict, List, Union
+from CarSpeedConfig import CarSpeedConfig
+from CarSpeedMonitor import CarSpeedMonitor, DetectionResult, Frame, FrameSource
+from CarSpeedSynthetic import SyntheticScene, SyntheticTraffic, SyntheticTrafficSource, SyntheticVehicle
+import argparse
+import json
+import time
+import numpy as np
+
+# runs the monitor over synthetic traffic and reports throughput, frame latency and how far the
+# measured speeds are from the true ones
+
+class TimingFrameSource(FrameSource):
+    # wraps a source and times how long the monitor spends on each frame, i.e. from handing a frame
+    # over to being asked for the next one. Only a true latency when the pipeline is not threaded
+    def __init__(self,source: FrameSource):
+        super().__init__(source.image_width,source.image_height)
+        self.source = source
+        self.frame_secs: List[float] = []
+        self._handed_over: Union[float,None] = None
+
+    def start(self):
+        self.source.start()
+
+    def stop(self):
+        self.source.stop()
+
+    def capture_frame(self)->Union[Frame,None]:
+        if self._handed_over is not None:
+            self.frame_secs.append(time.perf_counter()-self._handed_over)
+        frame = self.source.capture_frame()
+        self._handed_over = time.perf_counter()
+        return frame
+
+    def get_frame_duration_ns(self)->Union[int,None]:
+        return self.source.get_frame_duration_ns()
+
+    def set_night_mode(self):
+        super().set_night_mode()
+        self.source.set_night_mode()
+
+    def set_day_mode(self):
+        super().set_day_mode()
+        self.source.set_day_mode()
+
+def match_results(source: SyntheticTrafficSource,results: List[DetectionResult],tolerance_secs: float=1.0)->Dict[str,object]:
+    # pair each result with the unmatched vehicle going the same way that left the monitored area
+    # nearest in time to it. Vehicles still crossing when the run ends are not counted
+    vehicles: List[SyntheticVehicle] = [v for v in source.traffic.vehicles if source.exit_secs(v) < source.traffic.duration_secs]
+    total = len(vehicles)
+    exits = {id(v): source.scene_to_posix(source.exit_secs(v)) for v in vehicles}
+    errors: List[float] = []
+    false_positives = 0
+    for result in sorted(results,key=lambda r: r.posix_time):
+        candidates = [v for v in vehicles if v.direction==result.direction and abs(exits[id(v)]-result.posix_time) <= tolerance_secs]
+        if not candidates:
+            false_positives += 1
+            continue
+        vehicle = min(candidates,key=lambda v: abs(exits[id(v)]-result.posix_time))
+        vehicles.remove(vehicle)
+        errors.append(result.mean_speed - vehicle.speed_mph)
+    e = np.array(errors)
+    return {'vehicles': total,
+            'detected': len(errors),
+            'missed': len(vehicles),
+            'false_positives': false_positives,
+            'mean_error_mph': float(e.mean()) if e.size else 0.0,
+            'mean_abs_error_mph': float(np.abs(e).mean()) if e.size else 0.0,
+            'rms_error_mph': float(np.sqrt((e*e).mean())) if e.size else 0.0,
+            'max_abs_error_mph': float(np.abs(e).max()) if e.size else 0.0}
+
+def run_benchmark(config: CarSpeedConfig,traffic: SyntheticTraffic,scene: SyntheticScene,fps: float=30)->Dict[str,object]:
+    source = SyntheticTrafficSource(config,traffic,scene,fps)
+    timing = TimingFrameSource(source)
+    results: List[DetectionResult] = []
+
+    def detection_hook(result: DetectionResult):
+        results.append(result)
+
+    # the monitor only reports speeds in range so open the range up
+    config.min_speed_save = 0
+    config.max_speed_save = 1000
+    monitor = CarSpeedMonitor(config,timing)
+    start = time.perf_counter()
+    monitor.start(detection_hook=detection_hook,logger_hook=lambda message: None)
+    elapsed = time.perf_counter()-start
+    frame_ms = np.array(timing.frame_secs)*1000
+    report: Dict[str,object] = {
+        'frames': source.frame_count,
+        'elapsed_secs': elapsed,
+        'fps': source.frame_count/elapsed if elapsed > 0 else 0.0,
+        'latency_ms': {f'p{p}': float(np.percentile(frame_ms,p)) for p in (50,90,99)} if frame_ms.size else {},
+    }
+    if frame_ms.size:
+        report['latency_ms']['max'] = float(frame_ms.max())
+    report['speed'] = match_results(source,results)
+    return report
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Benchmarks detection and tracking on synthetic traffic")
+    ap.add_argument("--file","-f", default=CarSpeedConfig.DEF_CONFIG_FILE, help="Config to benchmark")
+    ap.add_argument("--set", action='append', default=[], metavar="NAME=VALUE", help="Override a config setting, value is json")
+    ap.add_argument("--duration", type=float, default=60, help="Seconds of traffic")
+    ap.add_argument("--rate", type=float, default=10, help="Vehicles per minute")
+    ap.add_argument("--min-mph", type=float, default=15)
+    ap.add_argument("--max-mph", type=float, default=45)
+    ap.add_argument("--fps", type=float, default=30)
+    ap.add_argument("--light", type=float, default=1.0, help="1.0 is day, below 0.3 is night")
+    ap.add_argument("--noise", type=float, default=2.0, help="Sensor noise sd in grey levels")
+    ap.add_argument("--drift", type=float, default=0.0, help="Fractional brightness swing")
+    ap.add_argument("--rain", type=int, default=0, help="Rain streaks per frame")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--json", help="Also write the report to this file")
+    args = vars(ap.parse_args())
+
+    config = CarSpeedConfig.fromJsonFile(args["file"])
+    for setting in args["set"]:
+        (name,value) = setting.split('=',1)
+        setattr(config,name,json.loads(value))
+    traffic = SyntheticTraffic.random(args["duration"],args["rate"],args["min_mph"],args["max_mph"],seed=args["seed"])
+    scene = SyntheticScene(args["light"],args["noise"],args["drift"],rain=args["rain"],seed=args["seed"])
+    report = run_benchmark(config,traffic,scene,args["fps"])
+    print(json.dumps(report,indent=4))
+    if args["json"]:
+        with open(args["json"],'w') as f:
+            json.dump(report,f,indent=4)
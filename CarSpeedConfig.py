@@ -11,7 +11,7 @@ class MonitorArea(object):
         self.lower_right_x:int = 0
         self.lower_right_y:int = 0
         if data:
-            self.__dict__ = data
+            self.__dict__.update(data)
 
 class CarSpeedConfig(object):
     DEF_CONFIG_FILE = "CarSpeed.json"
@@ -30,8 +30,51 @@ class CarSpeedConfig(object):
         self.h_flip = False
         self.v_flip = False
         self.monitor_area = MonitorArea()
+        # run detection on the luma plane of a YUV420 lores stream rather than the RGB main stream
+        self.detect_on_lores = False
+        # run capture, detection/tracking and output on separate threads joined by bounded queues
+        self.pipeline_threads = False
+        self.pipeline_queue_size = 2
+        # what to do when a stage falls behind: BLOCK, DROP_NEWEST or DROP_OLDEST
+        self.pipeline_drop_policy = 'DROP_OLDEST'
+        # number of preallocated frame buffers shared by the pipeline, tracking data and previews
+        self.frame_pool_size = 64
+        # previews per second sent to the preview hook, 0 sends them only on request
+        self.preview_rate = 2
+        # weight given to each car free frame folded into the background, 0 just replaces it on each light level update
+        self.background_learning_rate = 0.05
+        # fold in every nth car free frame
+        self.background_update_interval = 5
+        # look for motion on the monitored area downscaled by 2 or 4, the edges used for the speed
+        # are then refined at full resolution
+        self.detect_scale = 1
+        # how the largest moving blob is found: 'components' (connectedComponentsWithStats) or 'contours'
+        self.blob_backend = 'components'
+        # 'luma' takes the median brightness of the monitored area, 'lux' uses the Lux libcamera reports
+        self.light_meter = 'luma'
+        # 'mean' of the per frame speeds, or a 'least_squares' fit of distance against time
+        self.speed_estimator = 'mean'
+        # 'single' tracks the largest moving object, 'multi' tracks every object so following cars are each measured
+        self.tracker = 'single'
+        # while nothing is being tracked only process every nth frame and, if not 0, run the camera at
+        # this frame rate. Motion switches back to every frame at the full rate for active_hold_secs
+        self.idle_decimation = 1
+        self.idle_frame_rate = 0
+        self.active_hold_secs = 2
+        # while waiting only run the full detector on frames where an 80 pixel wide copy of the
+        # monitored area has changed
+        self.motion_gate = False
+        # have the camera crop the monitored area out of the sensor image for detection, so it gets more
+        # pixels per metre. Needs per stream crops (pi 5), the main stream stays the full field of view
+        self.sensor_crop = False
+        # how tracking frames are stored in detection zips: 'jpeg' a jpg per frame, 'avi' one MJPEG avi or
+        # 'roi' a background jpg plus just the part of each frame around the vehicle
+        self.detection_payload = 'jpeg'
+        # if more than 0 only keep this many tracking frames, evenly spread from first to last
+        self.detection_keyframes = 0
+        # update rather than replace so settings missing from older config files keep their defaults
         if data:
-            self.__dict__ = data   
+            self.__dict__.update(data)
             
     def getL2RFrameWidthFt(self)->float:
         l2r_distance_ft = self.l2r_distance*CarSpeedConfig.M_TO_FT
@@ -1,15 +1,23 @@
-from typing import Callable, List, Tuple, Union
+from typing import Callable, Dict, List, Tuple, Union
 
 import psutil
 
 from CarSpeedConfig import CarSpeedConfig
 # import the necessary packages
-from picamera2 import Picamera2
-from libcamera import Transform
-from libcamera import controls
+try:
+    from picamera2 import Picamera2, MappedArray
+    from libcamera import Transform
+    from libcamera import controls
+    picamera_available = True
+except ImportError:
+    # frames can still be replayed from files without the camera stack
+    picamera_available = False
 from enum import IntEnum
 import time
 import math
+import threading
+import collections
+import bisect
 import datetime
 import cv2
 import numpy as np
@@ -52,44 +60,166 @@ class Logger:
         else:
             print(mess)
 
+def sensor_to_posix(timestamp_ns: int)->float:
+    # sensor timestamps are CLOCK_MONOTONIC nanoseconds so offset them to wall clock time
+    return (timestamp_ns + time.time_ns() - time.monotonic_ns()) / 1e9
+
+class FrameBuffer(object):
+    # refcounted image buffer, goes back to its pool when the last reference is released
+    def __init__(self,array,pool=None,owned: bool=False):
+        self.array = array
+        self._pool = pool
+        self._refs = 1
+        # an owned copy belongs to whoever detached it, releasing its holder leaves it alone
+        self.owned = owned
+
+    def retain(self)->'FrameBuffer':
+        if self._pool is not None:
+            self._pool._retain(self)
+        return self
+
+    def release(self):
+        # buffers not from a pool are left to the garbage collector
+        if self._pool is not None:
+            self._pool._release(self)
+
+    def detach(self)->'FrameBuffer':
+        # an owned copy that can be kept (or pickled) after this reference is released
+        buffer = FrameBuffer(self.array.copy(),owned=True)
+        self.release()
+        return buffer
+
+class FramePool(object):
+    # fixed set of preallocated frame sized buffers so the hot loop does not churn the allocator
+    def __init__(self,size: int,shape: Tuple[int,...],dtype=np.uint8):
+        self.shape = shape
+        self.dtype = dtype
+        self.size = size
+        self.overflow = 0
+        self._lock = threading.Lock()
+        self._free = [FrameBuffer(np.empty(shape,dtype),self) for i in range(size)]
+
+    def acquire(self)->FrameBuffer:
+        with self._lock:
+            if self._free:
+                buffer = self._free.pop()
+                buffer._refs = 1
+                return buffer
+            # pool exhausted (e.g. very long track) so fall back to allocating rather than stall capture
+            self.overflow += 1
+        return FrameBuffer(np.empty(self.shape,self.dtype))
+
+    def copy(self,image)->FrameBuffer:
+        buffer = self.acquire()
+        np.copyto(buffer.array,image)
+        return buffer
+
+    def available(self)->int:
+        return len(self._free)
+
+    def _retain(self,buffer: FrameBuffer):
+        with self._lock:
+            buffer._refs += 1
+
+    def _release(self,buffer: FrameBuffer):
+        with self._lock:
+            buffer._refs -= 1
+            if buffer._refs == 0:
+                self._free.append(buffer)
+
+    def getStatsStr(self)->str:
+        return f"frame pool free={self.available()}/{self.size} overflow={self.overflow}"
+
 class TrackingData(object):
-    def __init__(self,abs_chg: int,secs: float,mph: float,x: int,width: int,image):
+    # one per tracked frame so keep them small
+    __slots__ = ('abs_chg','secs','mph','x','width','timestamp_ns','_buffer')
+    def __init__(self,abs_chg: int,secs: float,mph: float,x: int,width: int,buffer: FrameBuffer,timestamp_ns: int=0):
         self.abs_chg = abs_chg
         self.secs = secs
         self.mph = mph
         self.x = x
         self.width = width
-        self.image=image.copy()
+        self.timestamp_ns = timestamp_ns
+        # borrow the frame rather than copying it
+        self._buffer = buffer.retain()
+
+    @property
+    def image(self):
+        return self._buffer.array if self._buffer else None
+
+    def set_image(self,buffer: FrameBuffer):
+        self._buffer = buffer
+
+    def release(self):
+        if self._buffer and not self._buffer.owned:
+            self._buffer.release()
+            self._buffer = None
+
+    def detach(self):
+        if self._buffer:
+            self._buffer = self._buffer.detach()
+
+    # fields not for serialization
+    _NOT_SERIALIZED = ('_buffer','timestamp_ns')
 
     @staticmethod    
     def _jsonDict(o: object)->dict:
-        d = dict(o.__dict__)
-        # remove fields not for serialization
-        del d['image']
-        return d
+        return {k: getattr(o,k) for k in TrackingData.__slots__ if not k in TrackingData._NOT_SERIALIZED}
 
     def toJson(self)->str:
         return json.dumps(self, default=TrackingData._jsonDict, indent=4)  
 
 
 class DetectionResult(object):
-    def __init__(self,cap_time: datetime.datetime, mean_speed: float,direction: DetectionDirection,sd: float,inExitZone: bool, tracking_data: List[TrackingData]):
+    __slots__ = ('posix_time','mean_speed','direction','sd','inExitZone','tracking_data','samples','dropped_frames','_image_buffer','configId')
+    def __init__(self,posix_time: float, mean_speed: float,direction: DetectionDirection,sd: float,inExitZone: bool, tracking_data: List[TrackingData], samples: int=0, dropped_frames: int=0):
         # need this to get it to serialize to json
-        self.posix_time = time.mktime(cap_time.timetuple())
+        self.posix_time = posix_time
         self.mean_speed = mean_speed
         self.direction = direction
         self.sd = sd
         self.inExitZone=inExitZone
         self.tracking_data=tracking_data
-        self.image=None
+        # number of tracking samples the speed was estimated from
+        self.samples=samples
+        # frames the camera produced during tracking that never reached the tracker, the speed is
+        # still right but it was measured from fewer frames than it should have been
+        self.dropped_frames=dropped_frames
+        self._image_buffer: Union[FrameBuffer,None]=None
         self.configId=0
+
+    @property
+    def image(self):
+        return self._image_buffer.array if self._image_buffer else None
+
+    def set_image(self,buffer: FrameBuffer):
+        self._image_buffer = buffer
+
+    def release_image(self):
+        if self._image_buffer and not self._image_buffer.owned:
+            self._image_buffer.release()
+            self._image_buffer = None
+
+    def release(self):
+        # images are borrowed from the monitor's frame pool, this hands them back
+        self.release_image()
+        for td in self.tracking_data:
+            td.release()
+
+    def detach(self)->'DetectionResult':
+        # take owned copies of the images, needed by hooks that keep the result after returning
+        if self._image_buffer:
+            self._image_buffer = self._image_buffer.detach()
+        for td in self.tracking_data:
+            td.detach()
+        return self
     
     @staticmethod    
     def _jsonDict(o: object)->dict:
-        d = dict(o.__dict__)
+        if isinstance(o,TrackingData):
+            return TrackingData._jsonDict(o)
         # remove fields not for serialization
-        del d['image']
-        return d
+        return {k: getattr(o,k) for k in DetectionResult.__slots__ if k!='_image_buffer'}
 
     def toJson(self)->str:
         return json.dumps(self, default=DetectionResult._jsonDict, indent=4)  
@@ -104,27 +234,127 @@ class CameraMode(IntEnum):
     DAY=1
     NIGHT=2
 
-class CarSpeedCamera(object):
+class FrameSource(object):
+    # where CarSpeedMonitor gets its frames from, the camera or a recording being replayed
+    def __init__(self,image_width: int,image_height: int):
+        self.image_width=image_width
+        self.image_height=image_height
+        self.mode = CameraMode.NOT_SET
+        # True if detect_image is already just the monitored area, cropped by the camera, in which case
+        # it has pixel_scale times as many pixels across as the monitored area of the full image
+        self.sensor_crop = False
+        self.pixel_scale = 1.0
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def capture_frame(self)->Union['Frame',None]:
+        # None once a recording has run out
+        raise NotImplementedError
+
+    def get_frame_duration_ns(self)->Union[int,None]:
+        # nominal time between frames, None if unknown
+        return None
+
+    def set_frame_rate(self,frame_rate: float):
+        pass
+
+    def set_night_mode(self):
+        self.mode=CameraMode.NIGHT
+
+    def set_day_mode(self):
+        self.mode=CameraMode.DAY
+
+    def set_flip(self,h_flip: bool, v_flip: bool):
+        pass
+
+    def set_streams(self, use_lores: bool, buffer_count: int, detect_area: Union[None,Tuple[int,int,int,int]]=None):
+        pass
+
+class CarSpeedCamera(FrameSource):
     FRAME_RATE=30
-    def __init__(self,h_flip: bool,v_flip: bool):
-        # same aspect ratio as sensor but heavily reduced for speed of processing
-        self.image_width=640
-        self.image_height=380
+    BUFFER_COUNT=4
+    # same aspect ratio as sensor but heavily reduced for speed of processing
+    IMAGE_WIDTH=640
+    IMAGE_HEIGHT=380
+    def __init__(self,h_flip: bool,v_flip: bool,use_lores: bool=False,buffer_count: int=BUFFER_COUNT,\
+                 detect_area: Union[None,Tuple[int,int,int,int]]=None):
+        if not picamera_available:
+            raise RuntimeError("picamera2 is not available, frames can only be replayed")
+        super().__init__(CarSpeedCamera.IMAGE_WIDTH,CarSpeedCamera.IMAGE_HEIGHT)
         self.h_flip = h_flip
         self.v_flip = v_flip
+        self.use_lores = use_lores
+        self.buffer_count = buffer_count
+        # (x,y,w,h) of the monitored area in the main image to have the ISP crop for detection
+        self.detect_area = detect_area
+        self.detect_size = (self.image_width,self.image_height)
+        # in us, lengthened while the road is empty
+        self.frame_duration = CarSpeedCamera.getFrameDuration()
         self.picam = Picamera2()
-        # sensor_mode[1] is the full-frame fast frame rate camera of the pi camera 3
-        self.config = self.picam.create_preview_configuration(main={"size": (self.image_width, self.image_height),"format": "RGB888"},
-                                                              transform = Transform(hflip=self.h_flip,vflip=self.v_flip),
-                                                              queue=False,
-                                                              raw=self.picam.sensor_modes[1])
+        self.config = self.create_config()
         #
         self.picam.configure(self.config)
-        self.mode = CameraMode.NOT_SET
+
+    def create_config(self):
+        # optional YUV420 lores stream the same size as main so its Y plane can be used for detection
+        # without converting the RGB main stream to gray on every frame. With a detect area the lores
+        # stream is cropped to it by the ISP instead, so the monitored area gets more pixels while main
+        # stays the full field of view for previews and evidence. That needs per stream crops, which
+        # only newer libcamera on the pi 5 has, otherwise the area is cropped in software as before
+        self.sensor_crop = self.detect_area is not None and "ScalerCrops" in self.picam.camera_controls
+        if self.detect_area is not None and not self.sensor_crop:
+            print("ScalerCrops not supported, cropping the monitored area in software")
+        stream_controls = {}
+        if self.sensor_crop:
+            (x,y,w,h) = self.detect_area
+            # as big as fits in main, lores can't be bigger. YUV420 needs even sizes
+            scale = min(self.image_width/w,self.image_height/h)
+            self.detect_size = (int(w*scale)&~1,int(h*scale)&~1)
+            self.pixel_scale = self.detect_size[0]/w
+            full = self.full_frame_crop()
+            stream_controls["ScalerCrops"] = [full,self.area_to_sensor(self.detect_area,full)]
+        else:
+            self.detect_size = (self.image_width,self.image_height)
+            self.pixel_scale = 1.0
+        lores = {"size": self.detect_size,"format": "YUV420"} if self.use_lores or self.sensor_crop else None
+        # sensor_mode[1] is the full-frame fast frame rate camera of the pi camera 3
+        return self.picam.create_preview_configuration(main={"size": (self.image_width, self.image_height),"format": "RGB888"},
+                                                       lores=lores,
+                                                       transform = Transform(hflip=self.h_flip,vflip=self.v_flip),
+                                                       queue=False,
+                                                       buffer_count=self.buffer_count,
+                                                       raw=self.picam.sensor_modes[1],
+                                                       controls=stream_controls)
+
+    def full_frame_crop(self)->Tuple[int,int,int,int]:
+        # the sensor area main shows, the largest centred rect of main's aspect ratio
+        props = self.picam.camera_properties
+        (mx,my,mw,mh) = props["ScalerCropMaximum"] if "ScalerCropMaximum" in props else (0,0,*props["PixelArraySize"])
+        aspect = self.image_width/self.image_height
+        (fw,fh) = (mw,int(mw/aspect)) if mw/mh < aspect else (int(mh*aspect),mh)
+        return (mx+(mw-fw)//2,my+(mh-fh)//2,fw,fh)
+
+    def area_to_sensor(self,area: Tuple[int,int,int,int],full: Tuple[int,int,int,int])->Tuple[int,int,int,int]:
+        # main image pixels to sensor pixels, flips are applied after cropping so mirror the area
+        (x,y,w,h) = area
+        if self.h_flip:
+            x = self.image_width - (x+w)
+        if self.v_flip:
+            y = self.image_height - (y+h)
+        (fx,fy,fw,fh) = full
+        sx = fw/self.image_width
+        sy = fh/self.image_height
+        return (fx+int(x*sx),fy+int(y*sy),int(w*sx),int(h*sy))
 
     def start(self):
         self.picam.start()
         self.set_day_mode()
+        # allow the camera to warm up
+        time.sleep(0.9)
 
     def update_h_flip(self, h_flip):
         self.h_flip = self.config['transform'].hflip = h_flip
@@ -139,24 +369,66 @@ class CarSpeedCamera(object):
         self.picam.start()
     
     def set_flip(self,h_flip: bool, v_flip: bool):
-        self.h_flip = self.config['transform'].hflip = h_flip
-        self.v_flip = self.config['transform'].vflip = v_flip
+        self.h_flip = h_flip
+        self.v_flip = v_flip
+        # the sensor crop depends on the flips
+        self.config = self.create_config()
+        self.picam.configure(self.config)
+
+    def set_streams(self, use_lores: bool, buffer_count: int, detect_area: Union[None,Tuple[int,int,int,int]]=None):
+        if use_lores==self.use_lores and buffer_count==self.buffer_count and detect_area==self.detect_area:
+            return
+        self.use_lores = use_lores
+        self.buffer_count = buffer_count
+        self.detect_area = detect_area
+        self.config = self.create_config()
         self.picam.configure(self.config)
 
+    def capture_frame(self)->'Frame':
+        # one request gives the pixels and the metadata of the same frame
+        request = self.picam.capture_request()
+        metadata = request.get_metadata()
+        # map the buffer rather than copying it out, detection runs on it in place
+        use_lores = self.use_lores or self.sensor_crop
+        mapped = MappedArray(request, 'lores' if use_lores else 'main')
+        mapped.__enter__()
+        if use_lores:
+            # YUV420 arrays are (height*3/2, stride) with the Y plane in the top rows
+            image = None
+            (width,height) = self.detect_size
+            detect_image = mapped.array[:height,:width]
+        else:
+            image = detect_image = mapped.array
+        frame = Frame(image,detect_image,metadata["SensorTimestamp"],metadata,request,mapped)
+        # libcamera numbers every request it completes, including the ones never picked up
+        frame.sequence = getattr(getattr(request,'request',None),'sequence',None)
+        return frame
+
+    def get_frame_duration_ns(self)->int:
+        return self.frame_duration*1000
+
+    def set_frame_rate(self,frame_rate: float):
+        # takes effect a few frames later, FrameDuration in each frame's metadata follows it
+        duration = int(1000000/frame_rate)
+        if duration==self.frame_duration:
+            return
+        self.frame_duration = duration
+        self.picam.set_controls({'FrameDurationLimits': (duration,duration)})
+
     def stop(self):
         self.picam.stop()
     
     def set_night_mode(self):
         if self.mode==CameraMode.NIGHT:
             return
-        frameDuration = CarSpeedCamera.getFrameDuration()
+        frameDuration = self.frame_duration
         self.picam.set_controls({"AeEnable": False,'FrameDurationLimits': (frameDuration,frameDuration),"ExposureTime": 30000, "AnalogueGain": 3.0})
         self.mode=CameraMode.NIGHT
     
     def set_day_mode(self):
         if self.mode==CameraMode.DAY:
             return
-        frameDuration = CarSpeedCamera.getFrameDuration()
+        frameDuration = self.frame_duration
         print(f'set_day_mode frameDuration {frameDuration}')
         self.picam.set_controls({
                                 "AeEnable": True,
@@ -171,16 +443,177 @@ class CarSpeedCamera(object):
         duration = 1000000/CarSpeedCamera.FRAME_RATE
         return int(duration)
 
+class LightMeter(object):
+    # median brightness on a 0-256 scale, cheap enough to take every frame. Either from a
+    # subsampled luma (or HSV value) plane or from the Lux libcamera reports in the frame metadata
+    LUX_FULL_SCALE=3   # log10 of the lux taken as full brightness
+
+    def __init__(self,source: str='luma',subsample: int=4)->None:
+        self.source=source
+        self.subsample=max(1,subsample)
+        self.light=0
+
+    def measure(self,image,metadata: Union[None,dict]=None)->int:
+        if self.source=='lux' and metadata and "Lux" in metadata:
+            self.light = self.lux_to_light(metadata["Lux"])
+        else:
+            self.light = self.median(image)
+        return self.light
+
+    def median(self,image)->int:
+        # matches the old calcHist walk, returns the number of bins needed to pass half the pixels
+        sample = image[::self.subsample,::self.subsample]
+        if sample.ndim==3:
+            # value channel of HSV is just the brightest of B, G and R (max(axis=2) is ~10x slower)
+            sample = np.maximum(np.maximum(sample[:,:,0],sample[:,:,1]),sample[:,:,2])
+        hist = np.bincount(sample.ravel(),minlength=256)
+        return int(np.searchsorted(np.cumsum(hist),sample.size/2,side='right'))+1
+
+    @staticmethod
+    def lux_to_light(lux: float)->int:
+        # lux covers several decades so map its log onto the same scale as the median
+        return int(min(math.log10(1+max(0,lux)),LightMeter.LUX_FULL_SCALE)*256/LightMeter.LUX_FULL_SCALE)
+
+class BackgroundModel(object):
+    # running average of the empty scene. The float32 accumulator follows slow light changes and
+    # the uint8 copy is what every frame is diffed against, so detection needs no conversions.
+    # If given a reduce function (e.g. downscale and blur) a reduced copy is cached for diffing
+    # and the native one kept for refining edges
+    def __init__(self,learning_rate: float,update_interval: int,reduce: Union[None,Callable[[np.ndarray],np.ndarray]]=None)->None:
+        self.learning_rate=learning_rate
+        self.update_interval=max(1,update_interval)
+        self._reduce=reduce
+        self._accumulator:Union[None,np.ndarray]=None
+        self._background:Union[None,np.ndarray]=None
+        self._reduced:Union[None,np.ndarray]=None
+        self._idle_frames=0
+        self.updates=0
+        self.rebuilds=0
+
+    def is_initialized(self)->bool:
+        return self._background is not None
+
+    def rebuild(self,gray)->None:
+        # start again from this frame, used when the scene changes too much to follow
+        self._accumulator = gray.astype(np.float32)
+        self._background = gray.copy()
+        self._update_reduced()
+        self._idle_frames=0
+        self.rebuilds+=1
+
+    def native(self)->np.ndarray:
+        return self._background
+
+    def diff(self,gray):
+        # gray must already be reduced the same way as the background
+        return cv2.absdiff(gray,self._reduced)
+
+    def update(self,gray)->None:
+        # only give this frames with nothing moving in them or cars get blended into the background
+        if self.learning_rate <= 0:
+            return
+        self._idle_frames+=1
+        if self._idle_frames < self.update_interval:
+            return
+        self._idle_frames=0
+        cv2.accumulateWeighted(gray,self._accumulator,self.learning_rate)
+        cv2.convertScaleAbs(self._accumulator,dst=self._background)
+        self._update_reduced()
+        self.updates+=1
+
+    def _update_reduced(self):
+        self._reduced = self._background if self._reduce is None else self._reduce(self._background)
+
+    def getStatsStr(self)->str:
+        return f"background updates={self.updates} rebuilds={self.rebuilds}"
+
+class MotionGate(object):
+    # a cheap look for change on a tiny copy of the monitored area so the full detector only runs when
+    # something might be there. Keeps its own running background of the tiny copy, learnt from frames
+    # the full detector found empty. Every refresh_interval frames the full detector runs anyway so the
+    # light level and the main background still follow the scene
+    WIDTH = 80
+    # fraction of the detector's min area (scaled down to the gate) that has to change
+    MIN_AREA_FRACTION = 0.25
+
+    def __init__(self,width: int=WIDTH,learning_rate: float=0.1,refresh_interval: int=15)->None:
+        self.width = width
+        self.learning_rate = learning_rate
+        self.refresh_interval = max(1,refresh_interval)
+        self._accumulator: Union[None,np.ndarray] = None
+        self._background: Union[None,np.ndarray] = None
+        self._small: Union[None,np.ndarray] = None
+        self._since_full = 0
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    def reset(self)->None:
+        self._background = None
+
+    def check(self,image,threshold: int,min_area: int)->bool:
+        # True if the full detector should run on this frame
+        (height,width) = image.shape[:2]
+        scale = min(1.0,self.width/width)
+        size = (max(1,int(width*scale)),max(1,int(height*scale)))
+        # bilinear is close to point sampling at this scale but is ~25x faster than INTER_AREA and
+        # anything the size of a car or headlight still covers plenty of samples
+        small = cv2.resize(image,size,interpolation=cv2.INTER_LINEAR)
+        self._small = small if small.ndim==2 else cv2.cvtColor(small,cv2.COLOR_BGR2GRAY)
+        if self._background is None or self._background.shape!=self._small.shape:
+            self._accumulator = self._small.astype(np.float32)
+            self._background = self._small.copy()
+            self._since_full = 0
+            return True
+        changed = cv2.countNonZero(cv2.threshold(cv2.absdiff(self._small,self._background),threshold,255,cv2.THRESH_BINARY)[1])
+        if changed >= max(1,min_area*scale*scale*MotionGate.MIN_AREA_FRACTION):
+            self.hits += 1
+        elif self._since_full+1 >= self.refresh_interval:
+            self.refreshes += 1
+        else:
+            self.misses += 1
+            self._since_full += 1
+            self.learn()
+            return False
+        self._since_full = 0
+        return True
+
+    def learn(self)->None:
+        # fold the last frame checked into the background, only for frames with nothing moving
+        if self._small is not None and self._accumulator is not None and self.learning_rate > 0:
+            cv2.accumulateWeighted(self._small,self._accumulator,self.learning_rate)
+            cv2.convertScaleAbs(self._accumulator,dst=self._background)
+
+    def getStatsStr(self)->str:
+        return f"motion gate hits={self.hits} misses={self.misses} refreshes={self.refreshes}"
+
 class ObjectDetector(object):
     
     BLURSIZE = (15,15)
     THRESHOLD = 25
     MIN_SAVE_BUFFER = 2
+    # most objects reported per frame, keeps the trackers' work bounded
+    MAX_OBJECTS = 8
 
-    def __init__(self, logger:Logger, day_min_area:int, night_min_area:int, camera:CarSpeedCamera)->None:
+    def __init__(self, logger:Logger, day_min_area:int, night_min_area:int, camera:FrameSource,\
+                 background_learning_rate:float=0.05, background_update_interval:int=5, detect_scale:int=1,\
+                 blob_backend:str='components', light_meter:str='luma', motion_gate:bool=False)->None:
         self.rect=(0,0,0,0)
+        # every object big enough, largest first
+        self.rects: List[Tuple[int,int,int,int]]=[]
         self.ncontours=0
-        self._base_image = None
+        # look for motion on a frame reduced by 2**levels, 1 or 2 levels keeps the blur kernel sensible
+        self._pyramid_levels = max(0,min(2,int(round(math.log2(max(1,detect_scale))))))
+        self.scale = 2**self._pyramid_levels
+        # pyrDown already smooths so the blur kernel shrinks with the scale, it has to stay odd
+        self._blursize = ((ObjectDetector.BLURSIZE[0]//self.scale)|1,(ObjectDetector.BLURSIZE[1]//self.scale)|1)
+        self.background = BackgroundModel(background_learning_rate,background_update_interval,\
+                                          self._reduce if self.scale>1 else None)
+        # 'components' picks the largest blob from connectedComponentsWithStats, 'contours' walks findContours
+        self._blob_backend = blob_backend
+        self.light_meter = LightMeter(light_meter)
+        # only used if asked for, detectObject skips frames it sees no change in
+        self.gate: Union[MotionGate,None] = MotionGate() if motion_gate else None
         self._lightlevel=-1
         self._last_lightlevel=0
         self._day_min_area=day_min_area
@@ -188,16 +621,20 @@ class ObjectDetector(object):
         self._adjusted_min_area=day_min_area
         self._adjusted_threshold=0
         self._adjusted_save_buffer=0
-        self._lightlevel_time:Union[None,datetime.datetime]=None
+        self._lightlevel_time:Union[None,float]=None
         self._first_pass=True
         self._camera=camera
         self.logger=logger
             
-    def update_base_image(self,gray)->None:
-        # if the base image has not been defined, initialize it
-        self._base_image = gray.copy().astype("float")    
+    @staticmethod
+    def light_to_level(light: int)->int:
+        return int((light-0) * (10-1) / (256-0) + 1)
+
+    def get_current_lightlevel(self)->int:
+        # as measured on the latest frame, the thresholds only follow it every 60secs
+        return ObjectDetector.light_to_level(self.light_meter.light)
 
-    def update_lightlevel(self,image,gray)->None:
+    def update_lightlevel(self,gray)->None:
         def get_save_buffer(light: float):
             save_buffer = int((100/(light - 0.5)) + ObjectDetector.MIN_SAVE_BUFFER)    
             return save_buffer
@@ -216,139 +653,340 @@ class ObjectDetector(object):
             # disabled for time being
             #return ObjectDetector.THRESHOLD
                 
-        def measure_light(hsvImg)->int:
-            #Determine luminance level of monitored area 
-            #returns the median from the histogram which contains 0 - 255 levels
-            hist = cv2.calcHist([hsvImg], [2], None, [256],[0,255])
-            windowsize = (hsvImg.size)/3   #There are 3 pixels per HSV value 
-            count = 0
-            sum = 0
-            for value in hist:
-                sum = sum + value
-                count +=1    
-                if (sum > windowsize/2):   #test for median
-                    break
-            return count 
-
-        def my_map(x: int, in_min:int , in_max: int, out_min: int, out_max: int)->int:
-            return int((x-in_min) * (out_max-out_min) / (in_max-in_min) + out_min)
-        
-        # capture colour for later when measuring light levels
-        hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-        #Set threshold and min area and save_buffer based on light readings
+        #Set threshold and min area and save_buffer based on the light measured on this frame
         self._last_lightlevel = self._lightlevel
-        self._lightlevel = my_map(measure_light(hsv),0,256,1,10)
+        self._lightlevel = self.get_current_lightlevel()
         if ( self._lightlevel < 4 ):
             self._camera.set_night_mode()
         else:
             self._camera.set_day_mode()
         self._adjusted_threshold = get_threshold(self._lightlevel)
-        self._adjusted_save_buffer = get_save_buffer(self._lightlevel)
+        # in detection pixels, there are more of them if the camera crops the monitored area
+        self._adjusted_save_buffer = int(get_save_buffer(self._lightlevel)*self._camera.pixel_scale)
         #
         self._adjusted_min_area = self.get_min_area()
         print(f"LIGHT_LEVEL_UPDATE: (level={self._lightlevel}) (min_area={self._adjusted_min_area}) (threshold={self._adjusted_threshold}) (save_buffer={self._adjusted_save_buffer}))")
-        self._lightlevel_time=datetime.datetime.now()        
-        ###if ( self._last_lightlevel!=self._lightlevel):
-        ###    self.update_base_image(gray)
-        ### since I can;t get accumulateWeithed to work always refresh the base_image when the lightlevel taken
-        self.update_base_image(gray)
+        self._lightlevel_time=time.monotonic()        
+        # the background model follows gradual changes itself, only start again when the level
+        # (and so possibly the camera mode and threshold) has moved. With it switched off the base
+        # image is replaced on every update as it always was
+        if not self.background.is_initialized() or self._last_lightlevel!=self._lightlevel or self.background.learning_rate <= 0:
+            self.background.rebuild(gray)
+
+    def is_night_mode(self)->bool:
+        return self._camera.mode==CameraMode.NIGHT
 
     def get_min_area(self)->int:
-        if ( self._camera.mode==CameraMode.NIGHT ):
+        if ( self.is_night_mode() ):
             return self._night_min_area
         else:
             return self._day_min_area
         
     def reset(self):
         self._first_pass=True
+        self._lightlevel=-1
+        if self.gate is not None:
+            self.gate.reset()
     
     def needs_lightlevel_update(self)->bool:
-        return not self._lightlevel_time is None and (datetime.datetime.now()-self._lightlevel_time).total_seconds() > 60
+        return not self._lightlevel_time is None and (time.monotonic()-self._lightlevel_time) > 60
 
-    def detectObject(self,image)->bool:
-        # convert the frame to grayscale, and blur it
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        gray = cv2.GaussianBlur(gray, ObjectDetector.BLURSIZE, 0)
-    
-        # if the base image has not been defined, initialize it
-        #if self._base_image is None:
-        #    self.update_base_image(image)
+    def _reduce(self,gray):
+        for _ in range(self._pyramid_levels):
+            gray = cv2.pyrDown(gray)
+        return cv2.GaussianBlur(gray, self._blursize, 0)
+
+    def _refine_edges(self,gray,rect:Tuple[int,int,int,int])->Tuple[int,int,int,int]:
+        # the rect found on the reduced frame is only good to a few pixels. Speeds are worked
+        # out from its left or right edge so find those again in narrow full resolution strips
+        (x,y,w,h) = rect
+        background = self.background.native()
+        (height,width) = gray.shape[:2]
+        margin = 3*self.scale
+        pad = ObjectDetector.BLURSIZE[0]//2
+        y0,y1 = max(0,y-pad),min(height,y+h+pad)
+
+        def columns_over_threshold(x0,x1):
+            # blur a padded strip the way a full resolution pass would, then drop the padding
+            px0,px1 = max(0,x0-pad),min(width,x1+pad)
+            a = cv2.GaussianBlur(gray[y0:y1,px0:px1], ObjectDetector.BLURSIZE, 0)
+            b = cv2.GaussianBlur(background[y0:y1,px0:px1], ObjectDetector.BLURSIZE, 0)
+            delta = cv2.absdiff(a,b)[y-y0:y-y0+h,max(0,x0)-px0:min(width,x1)-px0]
+            return max(0,x0)+np.flatnonzero((delta > self._adjusted_threshold).any(axis=0))
+
+        cols = columns_over_threshold(x-margin,x+margin)
+        left = int(cols[0]) if cols.size else x
+        cols = columns_over_threshold(x+w-margin,x+w+margin)
+        right = int(cols[-1])+1 if cols.size else x+w
+        if right <= left:
+            return rect
+        return (left,y,right-left,h)
+
+    def _find_blob_contours(self,thresh)->Tuple[List[Tuple[int,int,int,int]],int]:
+        # look for bounding rects of objects
+        found: List[Tuple[int,Tuple[int,int,int,int]]] = []
+        (cnts, _) = cv2.findContours(thresh, cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_SIMPLE)
+        # examine the contours, keeping those big enough
+        for c in cnts:
+            (x, y, w, h) = cv2.boundingRect(c)
+            # back to full resolution pixels
+            (x, y, w, h) = (x*self.scale, y*self.scale, w*self.scale, h*self.scale)
+            # get an approximate area of the contour
+            found_area = w*h
+            if (found_area > self._adjusted_min_area):  
+                found.append((found_area,(x,y, w, h)))
+        # largest first, the sort is stable so ties keep contour order
+        found.sort(key=lambda f: f[0], reverse=True)
+        return ([rect for (_,rect) in found[:ObjectDetector.MAX_OBJECTS]], len(cnts))
+
+    def _find_blob_components(self,thresh)->Tuple[List[Tuple[int,int,int,int]],int]:
+        # same selection as _find_blob_contours but done on the stats array in one go, so the
+        # cost does not grow with the number of blobs in rain or snow
+        # 16 bit labels are plenty for a 640x380 frame and run more than twice as fast as 32 bit
+        (n, _, stats, _) = cv2.connectedComponentsWithStats(thresh, connectivity=8, ltype=cv2.CV_16U)
+        if n <= 1:
+            return ([], 0)
+        # label 0 is the background
+        stats = stats[1:]
+        areas = stats[:,cv2.CC_STAT_WIDTH]*stats[:,cv2.CC_STAT_HEIGHT]*(self.scale*self.scale)
+        big = np.flatnonzero(areas > self._adjusted_min_area)
+        # largest first
+        big = big[np.argsort(-areas[big],kind='stable')][:ObjectDetector.MAX_OBJECTS]
+        rects = [tuple(int(v)*self.scale for v in stats[i,:cv2.CC_STAT_AREA]) for i in big]
+        return (rects, n-1)
+
+    def detectObject(self,image,metadata: Union[None,dict]=None,use_gate: bool=True)->bool:
+        # the motion gate is only worth it while waiting for something to turn up
+        if self.gate is not None and use_gate and not self._first_pass and \
+                not self.gate.check(image,self._adjusted_threshold,self._adjusted_min_area):
+            self.rects = []
+            self.rect = (0,0,0,0)
+            self.ncontours = 0
+            return False
 
-        if self._first_pass:  #First pass through only get light level and define base_image
-            self.update_lightlevel(image,gray)
+        # convert the frame to grayscale (unless given the luma plane already), and blur it
+        # (after downscaling it if detecting at a reduced scale)
+        gray = image if image.ndim==2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        if self.scale > 1:
+            # the background is kept at full resolution for refining edges, the reduced copy is cached
+            native = gray
+            gray = self._reduce(native)
+        else:
+            native = gray = cv2.GaussianBlur(gray, ObjectDetector.BLURSIZE, 0)
+    
+        self.light_meter.measure(image,metadata)
+        if self._first_pass:  #First pass through only get light level and define the background
+            self.update_lightlevel(native)
             self._first_pass = False
 
         # compute the absolute difference between the current image and
-        # base image and then turn eveything lighter gray than THRESHOLD into
+        # background and then turn eveything lighter gray than THRESHOLD into
         # white
-        frameDelta = cv2.absdiff(gray, cv2.convertScaleAbs(self._base_image))
+        frameDelta = self.background.diff(gray)
         thresh = cv2.threshold(frameDelta, self._adjusted_threshold, 255, cv2.THRESH_BINARY)[1]
         
-        # dilate the thresholded image to fill in any holes, then find contours
+        # dilate the thresholded image to fill in any holes, then find blobs
         # on thresholded image
-        thresh = cv2.dilate(thresh, None, iterations=2)
-        (cnts, _) = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_SIMPLE)
-
-        # look for bounding rect of object
-        found_object:bool=False
-        biggest_area:int = 0
-        self.rect: Tuple[int,int,int,int] = (0,0,0,0)
-        self.ncontours = len(cnts)
-        # examine the contours, looking for the largest one
-        for c in cnts:
-            (x, y, w, h) = cv2.boundingRect(c)
-            # get an approximate area of the contour
-            found_area = w*h
-            # find the largest bounding rectangle
-            if (found_area > self._adjusted_min_area) and (found_area > biggest_area):  
-                biggest_area = found_area
-                found_object = True
-                self.rect = (x,y, w, h)
+        thresh = cv2.dilate(thresh, None, iterations=2 if self.scale==1 else 1)
+        if self._blob_backend == 'contours':
+            (self.rects, self.ncontours) = self._find_blob_contours(thresh)
+        else:
+            (self.rects, self.ncontours) = self._find_blob_components(thresh)
         #
+        if self.rects and self.scale > 1:
+            self.rects = [self._refine_edges(native,rect) for rect in self.rects]
+        found_object:bool = len(self.rects) > 0
+        # the largest
+        self.rect: Tuple[int,int,int,int] = self.rects[0] if found_object else (0,0,0,0)
         if not found_object:
-            ### can't get this to work so commented out
-            ### and re-do base_image when lightlevel taken
-            ###cv2.accumulateWeighted(gray, self._base_image, 0.25)
+            self.background.update(native)
+            if self.gate is not None and use_gate:
+                self.gate.learn()
             # update light level every 60secs assuming no car detected
             if self.needs_lightlevel_update():
-                self.update_lightlevel(image,gray)                
+                self.update_lightlevel(native)                
 
         #            
         return found_object
 
 
         
+class RunningStats(object):
+    # Welford's streaming mean and (population) standard deviation
+    __slots__ = ('count','mean','_m2')
+    def __init__(self)->None:
+        self.reset()
+
+    def reset(self)->None:
+        self.count=0
+        self.mean=0.0
+        self._m2=0.0
+
+    def push(self,value: float)->None:
+        self.count+=1
+        delta = value - self.mean
+        self.mean += delta/self.count
+        self._m2 += delta*(value - self.mean)
+
+    @property
+    def sd(self)->float:
+        return math.sqrt(self._m2/self.count) if self.count else 0.0
+
+class TrackingLog(object):
+    # per frame measurements of the object being tracked, kept in a preallocated record
+    # array that doubles when full so long slow crossings stay linear
+    DTYPE = np.dtype([('t','i8'),('x','i4'),('w','i4'),('abs_chg','i4'),('mph','f8')])
+    INITIAL_CAPACITY = 128
+
+    def __init__(self,capacity: int=INITIAL_CAPACITY)->None:
+        self._records = np.zeros(capacity,dtype=TrackingLog.DTYPE)
+        self._count = 0
+        # sensor timestamp tracking started from, where abs_chg is 0
+        self.start_ns = 0
+        # all speeds bar the latest, the last one is usually taken as the object leaves the area
+        self.stats = RunningStats()
+
+    def reset(self,start_ns: int=0)->None:
+        self._count = 0
+        self.start_ns = start_ns
+        self.stats.reset()
+
+    def __len__(self)->int:
+        return self._count
+
+    def append(self,timestamp_ns: int,x: int,w: int,abs_chg: int,mph: float)->None:
+        if self._count:
+            self.stats.push(float(self._records['mph'][self._count-1]))
+        if self._count == len(self._records):
+            self._records = np.resize(self._records,2*len(self._records))
+        self._records[self._count] = (timestamp_ns,x,w,abs_chg,mph)
+        self._count += 1
+
+    @property
+    def records(self)->np.ndarray:
+        return self._records[:self._count]
+
+    @property
+    def last_mph(self)->float:
+        return float(self._records['mph'][self._count-1]) if self._count else 0.0
+
+class SpeedEstimate(object):
+    __slots__ = ('mph','sd','samples')
+    def __init__(self,mph: float,sd: float,samples: int)->None:
+        self.mph = mph
+        self.sd = sd
+        self.samples = samples
+
+class SpeedEstimator(object):
+    # turns a tracking log into a speed, the log's abs_chg is the distance in pixels moved by the
+    # leading edge since tracking started
+    @staticmethod
+    def create(name: str)->'SpeedEstimator':
+        if name=='mean':
+            return MeanSpeedEstimator()
+        elif name=='least_squares':
+            return LeastSquaresSpeedEstimator()
+        raise ValueError(f"Unknown speed estimator [{name}]")
+
+    def estimate(self,log: TrackingLog,ftperpixel: float)->SpeedEstimate:
+        raise NotImplementedError
+
+class MeanSpeedEstimator(SpeedEstimator):
+    # mean of the per frame speeds, each measured from where tracking started
+    def estimate(self,log: TrackingLog,ftperpixel: float)->SpeedEstimate:
+        if (len(log) > 2): 
+            #Mean and SD of all items except the last one
+            return SpeedEstimate(log.stats.mean,log.stats.sd,len(log)-1)
+        elif (len(log) > 1):
+            # use the last element in the log, with a very high SD to highlight it's not to be trusted
+            return SpeedEstimate(log.last_mph,99,1)
+        return SpeedEstimate(0,0,0)
+
+class LeastSquaresSpeedEstimator(SpeedEstimator):
+    # fits distance moved against time and repeatedly drops samples more than REJECT_SIGMAS (robust)
+    # standard deviations off the line. sd is the standard error of the fitted speed. Less noisy than
+    # the mean of per frame speeds, so holds up better at lower frame rates
+    REJECT_SIGMAS = 3.0
+    MAX_ITERATIONS = 3
+    MIN_SAMPLES = 3
+
+    def estimate(self,log: TrackingLog,ftperpixel: float)->SpeedEstimate:
+        records = log.records
+        if len(records) > 2:
+            # like the mean estimator drop the last sample, the object is usually leaving the area
+            records = records[:-1]
+        # start with the point tracking started from
+        t = np.concatenate(([0.0],(records['t']-log.start_ns)*1e-9))
+        d = np.concatenate(([0.0],records['abs_chg'].astype(np.float64)))
+        if len(t) < LeastSquaresSpeedEstimator.MIN_SAMPLES:
+            return MeanSpeedEstimator().estimate(log,ftperpixel)
+        keep = np.ones(len(t),dtype=bool)
+        for _ in range(LeastSquaresSpeedEstimator.MAX_ITERATIONS):
+            (slope,intercept,_) = LeastSquaresSpeedEstimator.fit(t[keep],d[keep])
+            residuals = d - (slope*t + intercept)
+            # median absolute deviation scaled to a standard deviation
+            sigma = 1.4826*np.median(np.abs(residuals[keep] - np.median(residuals[keep])))
+            if sigma == 0:
+                break
+            inliers = np.abs(residuals) <= LeastSquaresSpeedEstimator.REJECT_SIGMAS*sigma
+            if inliers.sum() < LeastSquaresSpeedEstimator.MIN_SAMPLES or np.array_equal(inliers,keep):
+                break
+            keep = inliers
+        (slope,_,stderr) = LeastSquaresSpeedEstimator.fit(t[keep],d[keep])
+        to_mph = ftperpixel*0.681818    # Magic number to convert fps to mph
+        return SpeedEstimate(slope*to_mph,stderr*to_mph,int(keep.sum()))
+
+    @staticmethod
+    def fit(t: np.ndarray,d: np.ndarray)->Tuple[float,float,float]:
+        # returns slope, intercept and the standard error of the slope
+        n = len(t)
+        tt = t - t.mean()
+        sxx = float(np.dot(tt,tt))
+        if sxx == 0:
+            return (0.0,float(d.mean()),0.0)
+        slope = float(np.dot(tt,d))/sxx
+        intercept = float(d.mean()) - slope*float(t.mean())
+        r = d - (slope*t + intercept)
+        stderr = math.sqrt(float(np.dot(r,r))/(n-2)/sxx) if n > 2 else 0.0
+        return (slope,intercept,stderr)
+
 class ObjectTracking(object):
 
     TOO_CLOSE=0.4
     DETECTION_STATE_TEXT={ DetectionState.WAITING: 'WAITING', DetectionState.TRACKING: 'TRACKING', DetectionState.SAVING: 'SAVING'}
-    def __init__(self,logger: Logger, config: CarSpeedConfig,image_width: int,object_detector: ObjectDetector,moving_object_detected: Callable[[DetectionResult],None])->None:
+    def __init__(self,logger: Logger, config: CarSpeedConfig,image_width: int,object_detector: ObjectDetector,moving_object_detected: Callable[[DetectionResult],None],\
+                 pixel_scale: float=1.0)->None:
+        # pixel_scale is how many detection pixels there are to each pixel of the full image, more
+        # than 1 when the camera crops the monitored area out at a higher resolution
         #
         self.state = DetectionState.WAITING
         self.direction = DetectionDirection.UNKNOWN
         self.raw_tracking_data=[]
-        self.speeds:List[float]=list()
-        self.sd=0
+        self.log = TrackingLog()
+        self._speed_estimator = SpeedEstimator.create(config.speed_estimator)
         self._object_detector = object_detector
         self._initial_x=0
         self._initial_w=0
-        self._initial_time:datetime.datetime
-        self._cap_time:Union[datetime.datetime,None] = None
+        # sensor timestamps in ns
+        self._initial_time:int = 0
+        self._cap_time:Union[int,None] = None
         self._last_x=0
         self._counter=0
+        # frames dropped since tracking started
+        self._dropped_frames=0
         self._moving_object_detected=moving_object_detected
         ma = config.monitor_area
-        self._monitored_width = ma.lower_right_x - ma.upper_left_x
+        self._monitored_width = int((ma.lower_right_x - ma.upper_left_x)*pixel_scale)
         # work out ft per pixel in both directions
-        self._l2r_ftperpixel = config.getL2RFrameWidthFt() / float(image_width)
-        self._r2l_ftperpixel = config.getR2LFrameWidthFt() / float(image_width)
+        self._l2r_ftperpixel = config.getL2RFrameWidthFt() / float(image_width*pixel_scale)
+        self._r2l_ftperpixel = config.getR2LFrameWidthFt() / float(image_width*pixel_scale)
         #
         self.logger = logger
 
     # calculate elapsed seconds
     @staticmethod
-    def secs_diff(endTime: datetime.datetime, begTime:datetime.datetime)->float:
-        diff = (endTime - begTime).total_seconds()
+    def secs_diff(endTime: int, begTime: int)->float:
+        diff = (endTime - begTime) * 1e-9
         return diff
     
     # calculate speed from pixels and time
@@ -359,7 +997,7 @@ class ObjectTracking(object):
         else:
             return 0.0
         
-    def start_tracking(self, rect:Tuple[int,int,int,int], frame_timestamp: datetime.datetime)->None:
+    def start_tracking(self, rect:Tuple[int,int,int,int], frame_timestamp: int)->None:
         # intialize tracking
         (x,y,w,h) = rect
         self.state = DetectionState.TRACKING
@@ -372,15 +1010,15 @@ class ObjectTracking(object):
         self._initial_w = w
         self._initial_time = frame_timestamp
 
-        #Initialise array for storing speeds
-        self.speeds = np.array([])
-        self.sd=0  #Initialise standard deviation
+        #Initialise log of speeds
+        self.log.reset(frame_timestamp)
         
         self._counter = 0   # use to test later if saving with too few data points    
+        self._dropped_frames = 0
         self.logger.logMessage("x-chg    Secs      MPH  x-pos width     BA  DIR Count")
         if not self._cap_time == None:
             car_gap = ObjectTracking.secs_diff(self._initial_time, self._cap_time) 
-            self.logger.logMessage("initial time = "+str(self._initial_time) + " " + "cap_time =" + str(self._cap_time) + " gap= " +\
+            self.logger.logMessage("initial time = "+str(datetime.datetime.fromtimestamp(sensor_to_posix(self._initial_time))) + " " + "cap_time =" + str(datetime.datetime.fromtimestamp(sensor_to_posix(self._cap_time))) + " gap= " +\
                 str(car_gap) + " initial x= " + str(self._initial_x) + " initial_w= " + str(self._initial_w))
             # if gap between cars too low then probably seeing tail lights of current car
             #but I might need to tweek this if find I'm not catching fast cars
@@ -388,7 +1026,12 @@ class ObjectTracking(object):
                 self.state = DetectionState.WAITING
                 self.logger.logMessage("too close")
     
-    def check_tracking(self,frame_timestamp:datetime.datetime):
+    def note_dropped_frames(self,dropped: int)->None:
+        # called before update_state with the frames missed since the last one
+        if self.state==DetectionState.TRACKING:
+            self._dropped_frames += dropped
+
+    def check_tracking(self,frame_timestamp:int):
         # compute the elapsed time
         secs = ObjectTracking.secs_diff(frame_timestamp,self._initial_time)
         if secs >= 10: # Object taking too long to move across
@@ -404,61 +1047,60 @@ class ObjectTracking(object):
         return False
 
 
-    def update_tracking(self,rect:Tuple[int,int,int,int],image,frame_timestamp:datetime.datetime)->None:
-        
-        secs = ObjectTracking.secs_diff(frame_timestamp,self._initial_time)
+    def update_tracking(self,rect:Tuple[int,int,int,int],image: FrameBuffer,frame_timestamp:int)->None:
+        self._counter+=1   #Increment counter
+        (self.direction,finished) = self._record_position(rect,image,frame_timestamp,(self._initial_x,self._initial_w,self._initial_time),\
+                                                          self._last_x,self.log,self.raw_tracking_data)
+        # is front of object close to the exit of the monitored boundary? Then write date, time and speed on image
+        # and save it 
+        if finished:
+            self.finish_tracking(frame_timestamp, True)
+        else:
+            # if the object hasn't reached the end of the monitored area, just store last_x 
+            self._last_x = rect[0]
+
+    def _record_position(self,rect:Tuple[int,int,int,int],image: FrameBuffer,frame_timestamp:int,initial: Tuple[int,int,int],last_x: int,\
+                         log: TrackingLog,raw_tracking_data: List[TrackingData],label: str='')->Tuple[DetectionDirection,bool]:
+        # works out the direction and speed of an object from its initial x, width and time, logs them and
+        # keeps the frame. Used by both trackers, returns the direction and whether tracking is over because
+        # the object has reached the exit zone or gone backwards
+        (initial_x,initial_w,initial_time) = initial
+        secs = ObjectTracking.secs_diff(frame_timestamp,initial_time)
         (x,y,w,h) = rect
         area=w*h
 
-        if x >= self._last_x:
-            self.direction = DetectionDirection.LEFT_TO_RIGHT
-            abs_chg = (x + w) - (self._initial_x + self._initial_w)
+        if x >= last_x:
+            direction = DetectionDirection.LEFT_TO_RIGHT
+            abs_chg = (x + w) - (initial_x + initial_w)
             mph = ObjectTracking.get_speed(abs_chg,self._l2r_ftperpixel,secs)
         else:
-            self.direction = DetectionDirection.RIGHT_TO_LEFT
-            abs_chg = self._initial_x - x     
+            direction = DetectionDirection.RIGHT_TO_LEFT
+            abs_chg = initial_x - x     
             mph = ObjectTracking.get_speed(abs_chg,self._r2l_ftperpixel,secs)           
 
-        self._counter+=1   #Increment counter
-
-        self.speeds = np.append(self.speeds, mph)   #Append speed to array
+        log.append(frame_timestamp,x,w,abs_chg,mph)   #Append speed to log
 
         if mph < 0:
-            self.logger.logMessage("negative speed - stopping tracking"+ "{0:7.2f}".format(secs))
-            if self.direction == DetectionDirection.LEFT_TO_RIGHT:
-                self.direction = DetectionDirection.RIGHT_TO_LEFT  #Reset correct direction
-                x=1  #Force save
-            else:
-                self.direction = DetectionDirection.LEFT_TO_RIGHT  #Reset correct direction
-                x=self._monitored_width + ObjectDetector.MIN_SAVE_BUFFER  #Force save
-        else:
-            self.logger.logMessage(f"{abs_chg:4d}  {secs:7.2f}  {mph:7.0f}   {x:4d}  {w:4d} {area:6d} {int(self.direction):4d} {self._counter:5d}")
-            self.raw_tracking_data.append(TrackingData(abs_chg=abs_chg,secs=secs,mph=mph,x=x,width=w,image=image))
-        
-        # is front of object close to the exit of the monitored boundary? Then write date, time and speed on image
-        # and save it 
-        if ((x <= self._object_detector._adjusted_save_buffer) and (self.direction == DetectionDirection.RIGHT_TO_LEFT)) \
-                or ((x+w >= self._monitored_width - self._object_detector._adjusted_save_buffer) \
-                and (self.direction == DetectionDirection.LEFT_TO_RIGHT)):
-            self.finish_tracking(frame_timestamp, True)
-        else:
-            # if the object hasn't reached the end of the monitored area, just store last_x 
-            self._last_x = x
-
-    def finish_tracking(self, frame_timestamp:datetime.datetime, inExitZone: bool,)->None:
+            self.logger.logMessage(label + "negative speed - stopping tracking"+ "{0:7.2f}".format(secs))
+            #Reset correct direction and force save
+            if direction == DetectionDirection.LEFT_TO_RIGHT:
+                return (DetectionDirection.RIGHT_TO_LEFT,True)
+            return (DetectionDirection.LEFT_TO_RIGHT,True)
+        self.logger.logMessage(f"{label}{abs_chg:4d}  {secs:7.2f}  {mph:7.0f}   {x:4d}  {w:4d} {area:6d} {int(direction):4d} {len(log):5d}")
+        raw_tracking_data.append(TrackingData(abs_chg=abs_chg,secs=secs,mph=mph,x=x,width=w,buffer=image,timestamp_ns=frame_timestamp))
+        save_buffer = self._object_detector._adjusted_save_buffer
+        in_exit_zone = ((x <= save_buffer) and (direction == DetectionDirection.RIGHT_TO_LEFT)) \
+                or ((x+w >= self._monitored_width - save_buffer) and (direction == DetectionDirection.LEFT_TO_RIGHT))
+        return (direction,in_exit_zone)
+
+    def finish_tracking(self, frame_timestamp:int, inExitZone: bool,)->None:
         #Last frame has skipped the buffer zone    
-        if (self._counter > 2): 
-            mean_speed = np.mean(self.speeds[:-1])   #Mean of all items except the last one
-            sd = np.std(self.speeds[:-1])  #SD of all items except the last one
-        elif (self._counter > 1):
-            mean_speed = self.speeds[-1] # use the last element in the array
-            sd = 99 # Set it to a very high value to highlight it's not to be trusted.
-        else:
-            mean_speed = 0 #ignore it 
-            sd = 0
+        ftperpixel = self._l2r_ftperpixel if self.direction==DetectionDirection.LEFT_TO_RIGHT else self._r2l_ftperpixel
+        estimate = self._speed_estimator.estimate(self.log,ftperpixel)
                 
-        cap_time = frame_timestamp
-        result = DetectionResult(cap_time = cap_time, mean_speed = mean_speed, direction = self.direction, sd = sd, inExitZone=inExitZone, tracking_data=self.raw_tracking_data)
+        posix_time = sensor_to_posix(frame_timestamp)
+        result = DetectionResult(posix_time = posix_time, mean_speed = estimate.mph, direction = self.direction, sd = estimate.sd, inExitZone=inExitZone, tracking_data=self.raw_tracking_data, samples=estimate.samples, dropped_frames=self._dropped_frames)
+        self.raw_tracking_data = []
         # run callback
         self._moving_object_detected(result)
         #
@@ -468,9 +1110,13 @@ class ObjectTracking(object):
         # SAVING is used to wait until we get to state WAITING
         self.state = DetectionState.SAVING if inExitZone else DetectionState.WAITING
         self._last_x=0
+        # anything not handed on in a DetectionResult goes back to the frame pool
+        for td in self.raw_tracking_data:
+            td.release()
+        self.raw_tracking_data=[]
 
 
-    def update_state(self,found_object: bool, object_rect: Tuple[int,int,int,int],image,frame_timestamp: datetime.datetime):
+    def update_state(self,found_object: bool, object_rect: Tuple[int,int,int,int],image: FrameBuffer,frame_timestamp: int):
         if found_object:
             if self.state==DetectionState.WAITING:
                 # start off tracking
@@ -499,9 +1145,237 @@ class ObjectTracking(object):
     
     def getStateStr(self):
         return ObjectTracking.DETECTION_STATE_TEXT[self.state]
+
+    def getLiveStats(self)->Tuple[float,float]:
+        # mean and sd so far of the object being tracked
+        if self.state != DetectionState.TRACKING:
+            return (0.0,0.0)
+        return (self.log.stats.mean,self.log.stats.sd)
+
+class Track(object):
+    # one object followed by MultiObjectTracking
+    def __init__(self,track_id: int,rect: Tuple[int,int,int,int],frame_timestamp: int)->None:
+        (x,y,w,h) = rect
+        self.id = track_id
+        self.state = DetectionState.TRACKING
+        self.direction = DetectionDirection.UNKNOWN
+        self.rect = rect
+        self.initial_x = x
+        #if initial capture straddles start line then the
+        # front of vehicle is at position w when clock started
+        self.initial_w = w
+        self.initial_time = frame_timestamp
+        self.last_x = x
+        self.last_time = frame_timestamp
+        # of the centre of the rect, in pixels per second
+        self.vx = 0.0
+        self._has_moved = False
+        self.misses = 0
+        self.dropped_frames = 0
+        self.log = TrackingLog(32)
+        self.log.reset(frame_timestamp)
+        self.raw_tracking_data: List[TrackingData] = []
+
+    def predict(self,frame_timestamp: int)->Tuple[float,float,float,float]:
+        # constant velocity, objects only move across the monitored area
+        (x,y,w,h) = self.rect
+        return (x + self.vx*ObjectTracking.secs_diff(frame_timestamp,self.last_time),y,w,h)
+
+    def moved(self,rect: Tuple[int,int,int,int],frame_timestamp: int)->None:
+        secs = ObjectTracking.secs_diff(frame_timestamp,self.last_time)
+        if secs > 0:
+            vx = ((rect[0]+rect[2]/2) - (self.rect[0]+self.rect[2]/2))/secs
+            # smooth it a little, the rect edges jitter by a pixel or two
+            self.vx = 0.5*(self.vx + vx) if self._has_moved else vx
+            self._has_moved = True
+        self.rect = rect
+        self.last_time = frame_timestamp
+        self.misses = 0
+
+    def release(self)->None:
+        for td in self.raw_tracking_data:
+            td.release()
+        self.raw_tracking_data=[]
+
+class MultiObjectTracking(ObjectTracking):
+    # follows every object the detector reports rather than just the largest, so closely following
+    # cars are each measured and give their own DetectionResult. Objects are matched to tracks by
+    # the IoU of their rect with where the track is predicted to be, falling back to centroid distance
+    # for small objects such as headlights, which can move further than their own width between frames.
+    # At night the lights of one vehicle are merged into one object first. There is no TOO_CLOSE gap
+    # rule, a car's tail lights match its own track while it is SAVING instead
+    MAX_TRACKS = 8
+    # frames a track can go unmatched before it is finished
+    MAX_MISSES = 1
+    MIN_IOU = 0.1
+    TIMEOUT_SECS = 10
+    # tracking samples needed to give a speed
+    MIN_SAMPLES = 2
+
+    def __init__(self,logger: Logger, config: CarSpeedConfig,image_width: int,object_detector: ObjectDetector,moving_object_detected: Callable[[DetectionResult],None],\
+                 pixel_scale: float=1.0)->None:
+        super().__init__(logger,config,image_width,object_detector,moving_object_detected,pixel_scale)
+        self.tracks: List[Track] = []
+        self._next_id = 1
+        # furthest an object can plausibly move in a second, at the highest speed that would be saved
+        self._max_pixels_per_sec = config.max_speed_save/0.681818/min(self._l2r_ftperpixel,self._r2l_ftperpixel)
+
+    def reset_tracking(self, inExitZone):
+        for track in self.tracks:
+            track.release()
+        self.tracks = []
+        self.state = DetectionState.WAITING
+
+    def note_dropped_frames(self,dropped: int)->None:
+        for track in self.tracks:
+            if track.state == DetectionState.TRACKING:
+                track.dropped_frames += dropped
+
+    def update_state(self,found_object: bool, object_rect: Tuple[int,int,int,int],image: FrameBuffer,frame_timestamp: int):
+        rects = self._object_detector.rects if found_object else []
+        if rects and self._object_detector.is_night_mode():
+            rects = MultiObjectTracking.merge_lights(rects)
+        (matches, unmatched_rects) = self._associate(rects,frame_timestamp)
+        timed_out = False
+        for track in list(self.tracks):
+            rect = matches.get(track.id)
+            if ObjectTracking.secs_diff(frame_timestamp,track.initial_time) >= MultiObjectTracking.TIMEOUT_SECS:
+                # Object taking too long to move across
+                self._drop(track)
+                timed_out = True
+            elif rect is not None:
+                if track.state == DetectionState.TRACKING:
+                    self._update_track(track,rect,image,frame_timestamp)
+                track.moved(rect,frame_timestamp)
+            else:
+                track.misses += 1
+                if track.misses > MultiObjectTracking.MAX_MISSES:
+                    if track.state == DetectionState.TRACKING:
+                        # stop tracking since the vehicle is no longer detected
+                        self._finish_track(track,frame_timestamp,False)
+                    # means vehicle has passed out of view
+                    self._drop(track)
+        for rect in unmatched_rects:
+            if len(self.tracks) < MultiObjectTracking.MAX_TRACKS:
+                self._start_track(rect,frame_timestamp)
+        if timed_out:
+            # this forces a light level re-calc and base image refresh
+            self._object_detector.reset()      
+            self.logger.logMessage('Resetting detector')
+        states = [track.state for track in self.tracks]
+        if DetectionState.TRACKING in states:
+            self.state = DetectionState.TRACKING
+        elif states:
+            self.state = DetectionState.SAVING
+        else:
+            self.state = DetectionState.WAITING
+
+    def getLiveStats(self)->Tuple[float,float]:
+        # the oldest object being tracked
+        for track in self.tracks:
+            if track.state == DetectionState.TRACKING:
+                return (track.log.stats.mean,track.log.stats.sd)
+        return (0.0,0.0)
+
+    def _associate(self,rects: List[Tuple[int,int,int,int]],frame_timestamp: int)->Tuple[dict,List[Tuple[int,int,int,int]]]:
+        # greedy matching on a score matrix, at most MAX_TRACKS x MAX_OBJECTS
+        if not self.tracks or not rects:
+            return ({},list(rects))
+        pred = np.array([track.predict(frame_timestamp) for track in self.tracks],dtype=np.float64)[:,None,:]
+        det = np.array(rects,dtype=np.float64)[None,:,:]
+        iw = np.clip(np.minimum(pred[...,0]+pred[...,2],det[...,0]+det[...,2]) - np.maximum(pred[...,0],det[...,0]),0,None)
+        ih = np.clip(np.minimum(pred[...,1]+pred[...,3],det[...,1]+det[...,3]) - np.maximum(pred[...,1],det[...,1]),0,None)
+        inter = iw*ih
+        iou = inter/np.maximum(pred[...,2]*pred[...,3] + det[...,2]*det[...,3] - inter,1)
+        # centroid movement from the prediction along each track's direction of travel, either way while
+        # it is not known. It can be as far as the fastest vehicle saved would go, plus jitter of half a width
+        sign = np.array([1 if track.direction==DetectionDirection.LEFT_TO_RIGHT else -1 if track.direction==DetectionDirection.RIGHT_TO_LEFT else 0\
+                         for track in self.tracks],dtype=np.float64)[:,None]
+        reach = np.array([self._max_pixels_per_sec*ObjectTracking.secs_diff(frame_timestamp,track.last_time) for track in self.tracks],dtype=np.float64)[:,None]
+        dx = (det[...,0]+det[...,2]/2) - (pred[...,0]+pred[...,2]/2)
+        dy = np.abs((pred[...,1]+pred[...,3]/2) - (det[...,1]+det[...,3]/2))
+        jitter = np.maximum(pred[...,2],det[...,2])/2
+        gate_x = reach + jitter
+        gate_y = np.maximum(pred[...,3],det[...,3])/2
+        forward = np.where(sign != 0, sign*dx, np.abs(dx))
+        backward = np.where(sign != 0, -sign*dx, np.abs(dx))
+        # centroid matches always rank below IoU ones
+        near = (forward <= gate_x) & (backward <= np.where(sign != 0, jitter, gate_x)) & (dy <= gate_y)
+        score = np.where(iou >= MultiObjectTracking.MIN_IOU, iou,\
+                         np.where(near, 0.5*MultiObjectTracking.MIN_IOU*(1 - np.abs(dx)/(gate_x+1)), 0))
+        matches = {}
+        matched = set()
+        while True:
+            (t,r) = np.unravel_index(np.argmax(score),score.shape)
+            if score[t,r] <= 0:
+                break
+            matches[self.tracks[t].id] = rects[r]
+            matched.add(r)
+            score[t,:] = 0
+            score[:,r] = 0
+        return (matches,[rect for (r,rect) in enumerate(rects) if not r in matched])
+
+    @staticmethod
+    def merge_lights(rects: List[Tuple[int,int,int,int]])->List[Tuple[int,int,int,int]]:
+        # a vehicle's lights come out as blobs one above the other, closer together than they are high.
+        # Vehicles in other lanes are further apart than that
+        merged = [list(rect) for rect in rects]
+        joined = True
+        while joined:
+            joined = False
+            for i in range(len(merged)):
+                for j in range(i+1,len(merged)):
+                    (ax,ay,aw,ah) = merged[i]
+                    (bx,by,bw,bh) = merged[j]
+                    overlap = min(ax+aw,bx+bw) - max(ax,bx)
+                    gap = max(ay,by) - min(ay+ah,by+bh)
+                    if overlap >= min(aw,bw)/2 and gap <= min(ah,bh):
+                        x = min(ax,bx)
+                        y = min(ay,by)
+                        merged[i] = [x,y,max(ax+aw,bx+bw)-x,max(ay+ah,by+bh)-y]
+                        del merged[j]
+                        joined = True
+                        break
+                if joined:
+                    break
+        return [tuple(rect) for rect in merged]
+
+    def _start_track(self,rect: Tuple[int,int,int,int],frame_timestamp: int)->None:
+        track = Track(self._next_id,rect,frame_timestamp)
+        self._next_id += 1
+        self.tracks.append(track)
+        self.logger.logMessage(f"[{track.id}] x-chg    Secs      MPH  x-pos width     BA  DIR Count")
+
+    def _update_track(self,track: Track,rect: Tuple[int,int,int,int],image: FrameBuffer,frame_timestamp: int)->None:
+        (track.direction,finished) = self._record_position(rect,image,frame_timestamp,(track.initial_x,track.initial_w,track.initial_time),\
+                                                           track.last_x,track.log,track.raw_tracking_data,f"[{track.id}] ")
+        if finished:
+            self._finish_track(track,frame_timestamp,True)
+        else:
+            track.last_x = rect[0]
+
+    def _finish_track(self,track: Track,frame_timestamp: int,inExitZone: bool)->None:
+        # SAVING is used to wait until the object has gone
+        track.state = DetectionState.SAVING
+        if len(track.log) < MultiObjectTracking.MIN_SAMPLES:
+            # no speed to be had from it, most likely a blob that never matched again
+            self.logger.logMessage(f"[{track.id}] only {len(track.log)} samples, not saving")
+            track.release()
+            return
+        ftperpixel = self._l2r_ftperpixel if track.direction==DetectionDirection.LEFT_TO_RIGHT else self._r2l_ftperpixel
+        estimate = self._speed_estimator.estimate(track.log,ftperpixel)
+        posix_time = sensor_to_posix(frame_timestamp)
+        result = DetectionResult(posix_time = posix_time, mean_speed = estimate.mph, direction = track.direction, sd = estimate.sd, inExitZone=inExitZone, tracking_data=track.raw_tracking_data, samples=estimate.samples, dropped_frames=track.dropped_frames)
+        track.raw_tracking_data = []
+        # run callback
+        self._moving_object_detected(result)
+
+    def _drop(self,track: Track)->None:
+        track.release()
+        self.tracks.remove(track)
     
 class CarSpeedMonitorState:
-    def __init__(self,image,\
+    def __init__(self,buffer: FrameBuffer,\
                  state:str,\
                 frameRate:float,\
                 detectionEnabled: bool,\
@@ -509,8 +1383,14 @@ class CarSpeedMonitorState:
                 lightLevel: float,\
                 exposureTime: int,\
                 analogeGain: float,\
-                cpus: List[float]) -> None:
-        self.image=image.copy()
+                cpus: List[float],\
+                trackingSpeed: float=0,\
+                trackingSd: float=0,\
+                stageLatencies: Union[Dict[str,Dict[str,float]],None]=None,\
+                droppedFrames: int=0,\
+                queueDepths: Union[Dict[str,int],None]=None) -> None:
+        # borrowed from the frame pool, only valid until the preview hook returns unless detached
+        self._buffer=buffer.retain()
         self.state=state
         self.frameRate=frameRate
         self.detectionEnabled=detectionEnabled
@@ -519,22 +1399,398 @@ class CarSpeedMonitorState:
         self.exposureTime=exposureTime
         self.analogueGain=analogeGain
         self.cpus=cpus
+        # running mean/sd of the speed of the object currently being tracked
+        self.trackingSpeed=trackingSpeed
+        self.trackingSd=trackingSd
+        # per stage latency summaries since the last STATS line, frames dropped since the monitor started
+        # and how many items are waiting in the pipeline and uploader queues
+        self.stageLatencies=stageLatencies if stageLatencies else {}
+        self.droppedFrames=droppedFrames
+        self.queueDepths=queueDepths if queueDepths else {}
   
+    @property
+    def image(self):
+        return self._buffer.array
+
+    def set_image(self,buffer: FrameBuffer):
+        self._buffer = buffer
+
+    def detach(self)->'CarSpeedMonitorState':
+        self._buffer = self._buffer.detach()
+        return self
+
+    def release(self):
+        # a detached image may still be waiting to be pickled so leave it be
+        if hasattr(self,'_buffer') and not self._buffer.owned:
+            self._buffer.release()
+            del(self._buffer)
+
     def generateJpg(self):
         (result,jpg) = cv2.imencode('.jpg', self.image)
         self.jpg = jpg.data
-        del(self.image)
+        # only the jpg is sent, whether or not the image was detached
+        self._buffer.release()
+        del(self._buffer)
+
+class Frame(object):
+    # a captured frame plus everything the detect and output stages work out about it
+    def __init__(self,image,detect_image,timestamp_ns: int,metadata=None,request=None,mapped=None) -> None:
+        # main colour image, only valid after release_request if keep_image has been called
+        self.image = image
+        self.buffer: Union[FrameBuffer,None] = FrameBuffer(image) if request is None and image is not None else None
+        # full frame the detector works on, either the main image or the lores luma plane
+        self.detect_image = detect_image
+        self.cropped_image = None
+        # libcamera SensorTimestamp of this frame
+        self.timestamp_ns = timestamp_ns
+        # libcamera request sequence number if the source has one
+        self.sequence: Union[int,None] = None
+        # frames missed between the previous frame the detector saw and this one
+        self.dropped_before = 0
+        self.metadata = metadata
+        self.request = request
+        self._mapped = mapped
+        self.found_object = False
+        self.rect: Tuple[int,int,int,int] = (0,0,0,0)
+        self.rects: List[Tuple[int,int,int,int]] = []
+        self.ncontours = 0
+        self.state_str = ''
+        # mean and sd of the speed so far while tracking
+        self.live_stats: Tuple[float,float] = (0.0,0.0)
+        self.results: List[DetectionResult] = []
+        self.preview = False
+        # passed over by the scheduler while the road is empty
+        self.skipped = False
+
+    def keep_image(self,pool: FramePool):
+        # copy the main image out of the camera buffer into a pool buffer so it outlives release_request
+        if self.buffer is not None:
+            return
+        if self.image is None:
+            with MappedArray(self.request,'main') as m:
+                self.buffer = pool.copy(m.array)
+        else:
+            self.buffer = pool.copy(self.image)
+        self.image = self.buffer.array
+
+    def release_request(self):
+        # hand the camera buffer back to libcamera
+        if self.request is not None:
+            if self._mapped is not None:
+                self._mapped.__exit__(None,None,None)
+                self._mapped = None
+            self.request.release()
+            self.request = None
+            self.detect_image = self.cropped_image = None
+            if self.buffer is None:
+                self.image = None
+
+    def release(self):
+        # done with the frame, tracking data and previews hold their own references to the buffer
+        self.release_request()
+        if self.buffer is not None:
+            self.buffer.release()
+            self.buffer = None
+            self.image = None
+
+class DropPolicy(IntEnum):
+    BLOCK=0
+    DROP_NEWEST=1
+    DROP_OLDEST=2
+
+class FrameQueue(object):
+    # bounded queue between two pipeline stages that counts what passes through it
+    def __init__(self,name: str,maxsize: int,drop_policy: DropPolicy) -> None:
+        self.name = name
+        self.maxsize = max(1,maxsize)
+        self.drop_policy = drop_policy
+        self._items = collections.deque()
+        self._cond = threading.Condition()
+        self.put_count = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+    def put(self,item,droppable: bool=True):
+        # returns the item dropped to make room (if any) so the caller can release it
+        # items that are not droppable (end markers, frames with results) are always queued
+        dropped = None
+        with self._cond:
+            if droppable and self._droppable_depth() >= self.maxsize:
+                if self.drop_policy == DropPolicy.BLOCK:
+                    while self._droppable_depth() >= self.maxsize:
+                        self._cond.wait()
+                elif self.drop_policy == DropPolicy.DROP_NEWEST:
+                    self.dropped += 1
+                    return item
+                else:
+                    for entry in self._items:
+                        if entry[1]:
+                            self._items.remove(entry)
+                            dropped = entry[0]
+                            self.dropped += 1
+                            break
+            self._items.append((item,droppable))
+            self.put_count += 1
+            self.max_depth = max(self.max_depth,len(self._items))
+            self._cond.notify_all()
+        return dropped
+
+    def get(self):
+        with self._cond:
+            while not self._items:
+                self._cond.wait()
+            (item,droppable) = self._items.popleft()
+            self._cond.notify_all()
+            return item
+
+    def depth(self)->int:
+        return len(self._items)
+
+    def _droppable_depth(self)->int:
+        return sum(1 for entry in self._items if entry[1])
+
+    def getStatsStr(self)->str:
+        return f"{self.name} depth={self.depth()} max={self.max_depth} dropped={self.dropped}/{self.put_count}"
+
+class PreviewMailbox(object):
+    # single slot hand over to the preview thread, a newer preview replaces one not yet taken
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self._state = None
+        self._closed = False
+        self.posted = 0
+        self.replaced = 0
+
+    def post(self,state: 'CarSpeedMonitorState'):
+        with self._cond:
+            if self._state is not None:
+                self._state.release()
+                self.replaced += 1
+            self._state = state
+            self.posted += 1
+            self._cond.notify()
+
+    def take(self):
+        # returns None once closed and emptied
+        with self._cond:
+            while self._state is None and not self._closed:
+                self._cond.wait()
+            state = self._state
+            self._state = None
+            return state
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    def getStatsStr(self)->str:
+        return f"previews posted={self.posted} replaced={self.replaced}"
+
+class FrameDropCounter(object):
+    # counts the frames produced that the detector never saw, whether the camera skipped them or a
+    # pipeline queue dropped them. Uses gaps in the request sequence numbers when the source has them,
+    # otherwise gaps in the sensor timestamps against the frame duration
+    # timestamp gaps longer than this are a break in the recording, not drops
+    MAX_GAP_FRAMES = 30
+
+    def __init__(self,frame_duration_ns: Union[int,None]) -> None:
+        self.frame_duration_ns = frame_duration_ns
+        self.frames = 0
+        self.dropped = 0
+        # times one or more frames in a row were dropped
+        self.gaps = 0
+        self._last_sequence: Union[int,None] = None
+        self._last_timestamp: Union[int,None] = None
+
+    def update(self,frame: 'Frame')->int:
+        dropped = 0
+        if frame.sequence is not None and self._last_sequence is not None:
+            dropped = max(0,frame.sequence - self._last_sequence - 1)
+        elif self._last_timestamp is not None:
+            # FrameDuration is in us and follows the exposure when the frame rate is not fixed
+            duration = frame.metadata["FrameDuration"]*1000 if frame.metadata and "FrameDuration" in frame.metadata \
+                        else self.frame_duration_ns
+            if duration:
+                missed = int((frame.timestamp_ns - self._last_timestamp)/duration + 0.5) - 1
+                if missed <= FrameDropCounter.MAX_GAP_FRAMES:
+                    dropped = max(0,missed)
+        self._last_sequence = frame.sequence
+        self._last_timestamp = frame.timestamp_ns
+        self.frames += 1
+        if dropped:
+            self.dropped += dropped
+            self.gaps += 1
+        frame.dropped_before = dropped
+        return dropped
+
+    def getStatsStr(self)->str:
+        return f"frames dropped={self.dropped}/{self.frames+self.dropped} gaps={self.gaps}"
+
+class ProcessingScheduler(object):
+    # decides which frames get the detect pipeline. While nothing is being tracked only every
+    # idle_decimation-th frame is processed and the camera can be slowed to idle_frame_rate. Any
+    # motion or tracking switches straight back to every frame at the full rate, which is then held
+    # for active_hold_secs after the last of it so a car entering is not missed between frames
+    def __init__(self,frame_source: FrameSource,idle_decimation: int=1,idle_frame_rate: float=0,\
+                 active_hold_secs: float=2,frame_rate: float=CarSpeedCamera.FRAME_RATE) -> None:
+        self.frame_source = frame_source
+        self.idle_decimation = max(1,idle_decimation)
+        self.idle_frame_rate = idle_frame_rate
+        self.active_hold_ns = int(active_hold_secs*1e9)
+        self.frame_rate = frame_rate
+        self.idle = False
+        self.skipped = 0
+        self.switches = 0
+        self._last_active_ns: Union[int,None] = None
+        self._since_processed = 0
+
+    def enabled(self)->bool:
+        return self.idle_decimation > 1 or self.idle_frame_rate > 0
+
+    def should_process(self,frame: Frame)->bool:
+        if self.idle and self._since_processed+1 < self.idle_decimation:
+            self._since_processed += 1
+            self.skipped += 1
+            return False
+        self._since_processed = 0
+        return True
+
+    def update(self,state: DetectionState,motion: bool,frame_timestamp: int):
+        # called with each processed frame
+        if not self.enabled():
+            return
+        if state!=DetectionState.WAITING or motion or self._last_active_ns is None:
+            self._last_active_ns = frame_timestamp
+            if self.idle:
+                self._set_idle(False)
+        elif not self.idle and frame_timestamp - self._last_active_ns > self.active_hold_ns:
+            self._set_idle(True)
+
+    def _set_idle(self,idle: bool):
+        self.idle = idle
+        self.switches += 1
+        self._since_processed = 0
+        if self.idle_frame_rate > 0:
+            self.frame_source.set_frame_rate(self.idle_frame_rate if idle else self.frame_rate)
+
+    def getStatsStr(self)->str:
+        return f"scheduler {'idle' if self.idle else 'active'} skipped={self.skipped} switches={self.switches}"
+
+class LatencyHistogram(object):
+    # fixed buckets so recording a sample is a bisect and an increment, cheap enough to leave on.
+    # Percentiles are the upper edge of the bucket they fall in, capped at the worst seen
+    BUCKETS_MS = (0.5,1,2,5,10,20,33,50,100,200,500,1000)
+    _EDGES_NS = [int(ms*1000000) for ms in BUCKETS_MS]
+
+    def __init__(self,name: str) -> None:
+        self.name = name
+        self.counts = [0]*(len(LatencyHistogram.BUCKETS_MS)+1)
+        self.reset()
+
+    def reset(self):
+        for i in range(len(self.counts)):
+            self.counts[i] = 0
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def record(self,elapsed_ns: int):
+        self.counts[bisect.bisect_left(LatencyHistogram._EDGES_NS,elapsed_ns)] += 1
+        self.count += 1
+        self.total_ns += elapsed_ns
+        if elapsed_ns > self.max_ns:
+            self.max_ns = elapsed_ns
+
+    def mean_ms(self)->float:
+        return self.total_ns/self.count/1000000 if self.count else 0.0
+
+    def percentile_ms(self,p: float)->float:
+        if not self.count:
+            return 0.0
+        rank = p/100*self.count
+        seen = 0
+        for (i,n) in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                # the overflow bucket has no upper edge
+                edge = LatencyHistogram.BUCKETS_MS[i] if i < len(LatencyHistogram.BUCKETS_MS) else math.inf
+                return min(edge,round(self.max_ns/1000000,2))
+        return round(self.max_ns/1000000,2)
+
+    def summary(self)->Dict[str,float]:
+        return {'count': self.count,
+                'mean_ms': round(self.mean_ms(),2),
+                'p50_ms': self.percentile_ms(50),
+                'p90_ms': self.percentile_ms(90),
+                'p99_ms': self.percentile_ms(99),
+                'max_ms': round(self.max_ns/1000000,2)}
+
+    def getStatsStr(self)->str:
+        return f"{self.name} mean={self.mean_ms():.1f} p50={self.percentile_ms(50):g} p90={self.percentile_ms(90):g} "\
+               f"p99={self.percentile_ms(99):g} max={self.max_ns/1000000:.1f}ms"
+
+class StageTimings(object):
+    # a latency histogram per stage of the monitor loop. Each stage is only recorded from the thread
+    # it runs on, summaries read them from the output thread and may be a sample out
+    STAGES = ('capture_wait','detect','track','annotate','hooks')
+
+    def __init__(self) -> None:
+        self.histograms = {name: LatencyHistogram(name) for name in StageTimings.STAGES}
+
+    def record(self,stage: str,start_ns: int):
+        self.histograms[stage].record(time.perf_counter_ns()-start_ns)
+
+    def reset(self):
+        for histogram in self.histograms.values():
+            histogram.reset()
+
+    def limiting_stage(self)->str:
+        # the stage taking the most time per frame, capture_wait only leads when the camera is the limit
+        return max(self.histograms.values(),key=lambda h: h.mean_ms()).name
+
+    def summary(self)->Dict[str,Dict[str,float]]:
+        return {name: histogram.summary() for (name,histogram) in self.histograms.items()}
+
+    def getStatsStr(self)->str:
+        return ", ".join(h.getStatsStr() for h in self.histograms.values()) + f", limiting={self.limiting_stage()}"
 
 class CarSpeedMonitor(object):
-    
+
     WINDOW_NAME="Car Speed Monitor"
-    def __init__(self, config: CarSpeedConfig) -> None:
+    STATS_LOG_SECS=60
+    def __init__(self, config: CarSpeedConfig, frame_source: Union[FrameSource,None]=None) -> None:
         self.config = config
-        self.camera = CarSpeedCamera(self.config.h_flip,self.config.v_flip)
-    
-    def start(self, detection_hook:Callable, preview_hook=None, logger_hook=None, command_hook=None, show_preview=False):
+        # the camera unless given frames to replay
+        self.frame_source = frame_source if frame_source else \
+            CarSpeedCamera(self.config.h_flip,self.config.v_flip,self.config.detect_on_lores,self.get_buffer_count(),self.get_detect_area())
+        self.preview_rate = self.config.preview_rate
+        self._preview_requested = False
+
+    def set_preview_rate(self, preview_rate: float):
+        # previews per second sent to the preview hook, 0 means only when requested
+        self.preview_rate = preview_rate
+
+    def request_preview(self):
+        # send a preview for the next frame regardless of the preview rate
+        self._preview_requested = True
+
+    def get_detect_area(self)->Union[None,Tuple[int,int,int,int]]:
+        # the monitored area as (x,y,w,h) if the camera is to crop it out
+        if not self.config.sensor_crop:
+            return None
+        ma = self.config.monitor_area
+        return (ma.upper_left_x,ma.upper_left_y,ma.lower_right_x-ma.upper_left_x,ma.lower_right_y-ma.upper_left_y)
+
+    def get_buffer_count(self)->int:
+        # camera requests are held in the capture->detect queue so allow for them
+        if self.config.pipeline_threads:
+            return CarSpeedCamera.BUFFER_COUNT + self.config.pipeline_queue_size + 1
+        return CarSpeedCamera.BUFFER_COUNT
 
-        def annotate_main_image(result: DetectionResult):
+    def start(self, detection_hook:Callable, preview_hook=None, logger_hook=None, command_hook=None, show_preview=False, queue_depth_hook=None):
+
+        def annotate_main_image(image, result: DetectionResult):
             # timestamp the image - 
             cap_time = result.getCaptureTime()
             mean_speed = result.mean_speed
@@ -549,78 +1805,276 @@ class CarSpeedMonitor(object):
             (cntr_x , int(image_height * 0.2)), cv2.FONT_HERSHEY_SIMPLEX, 2.00, (0, 255, 0), 3)
 
         def moving_object_detected(result: DetectionResult):
+            # called from the tracking stage, the results are reported by the output stage
+            detected_results.append(result)
+
+        def report_detection(frame: Frame, result: DetectionResult):
             if (result.mean_speed > min_speed_save and result.mean_speed < max_speed_save):                
-                annotate_main_image(result)
-                result.image = image.copy()
+                result.set_image(frame_pool.copy(frame.image))
+                annotate_main_image(result.image,result)
                 if detection_hook:
                     detection_hook(result)
                 # print json version to std out
-                logger.logMessage(f'CAR_DETECTED: ({result.mean_speed:.1f} mph) (sd={result.sd:.2f})')
+                logger.logMessage(f'CAR_DETECTED: ({result.mean_speed:.1f} mph) (sd={result.sd:.2f})' +\
+                                  (f' (dropped frames={result.dropped_frames})' if result.dropped_frames else ''))
             else:
                 logger.logMessage(f"Ignoring detection - speed [{result.mean_speed:.2f}] out of range [{min_speed_save}-{max_speed_save}]")
+            # hooks that keep the result must have detached it
+            result.release()
 
-            
 
-        def annotate_image_for_storage(found_object: bool,object_rect:Tuple[int,int,int,int]): 
-            
+
+        def annotate_image_for_storage(frame: Frame):
+            image = frame.image
             # draw the timestamp and tracking state
-            cv2.putText(image, frame_timestamp.strftime("%A %d %B %Y %I:%M:%S%p"),
+            cap_time = datetime.datetime.fromtimestamp(sensor_to_posix(frame.timestamp_ns))
+            cv2.putText(image, cap_time.strftime("%A %d %B %Y %I:%M:%S%p"),
                 (10, image.shape[0] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (0, 255, 0), 1)
             # draw monitored area
             green = (0, 255, 0)
             cv2.rectangle(image,(upper_left_x,upper_left_y),(lower_right_x,lower_right_y),green)
-            # add last found object
-            if found_object:
-                blue = (255, 0, 0)
-                (x1,y1,w,h)=object_rect
+            # add last found objects
+            blue = (255, 0, 0)
+            for (x1,y1,w,h) in frame.rects:
+                # detection pixels back to pixels of the full image
+                (x1,y1,w,h) = [int(v/pixel_scale) for v in (x1,y1,w,h)]
                 x1+=upper_left_x
                 y1+=upper_left_y
                 x2=x1+w
                 y2=y1+h
                 cv2.rectangle(image,(x1,y1),(x2,y2),blue)
 
-        def annotate_image_for_preview(): 
-            
+        def annotate_image_for_preview(frame: Frame, image):
             # draw the timestamp and tracking state
-            cv2.putText(image, f"Tracking state: {object_tracking.getStateStr()}", (10, 20),
+            cv2.putText(image, f"Tracking state: {frame.state_str}", (10, 20),
                 cv2.FONT_HERSHEY_SIMPLEX,0.35, (0, 0, 255), 1)
             cv2.putText(image, f"Detection enabled: {detection_enabled}", (10, 35),
                 cv2.FONT_HERSHEY_SIMPLEX,0.35, (0, 0, 255), 1)
             cv2.putText(image, f"Frame rate: {frame_rate:3.0f} fps, avg contours: {num_contours:3.0f}", (10, 50),
-                cv2.FONT_HERSHEY_SIMPLEX,0.35, (0, 0, 255), 1)        
+                cv2.FONT_HERSHEY_SIMPLEX,0.35, (0, 0, 255), 1)
             cv2.putText(image, f"Enter 'q' to quit, 'd' to toggle detection", (10, 65),
                 cv2.FONT_HERSHEY_SIMPLEX,0.35, (0, 0, 255), 1)
 
-        def process_image():
-            found_object = object_detector.detectObject(cropped_image)
-            annotate_image_for_storage(found_object,object_detector.rect)
+        def needs_main_image(frame: Frame)->bool:
+            # the colour image is only used for evidence and previews
+            return frame.found_object or object_tracking.state!=DetectionState.WAITING or show_preview or frame.preview
+
+        def preview_due()->bool:
+            nonlocal next_preview_time
+            if preview_hook is None:
+                return False
+            if self._preview_requested:
+                self._preview_requested = False
+                return True
+            if self.preview_rate <= 0:
+                return False
+            now = time.monotonic()
+            if now < next_preview_time:
+                return False
+            next_preview_time = now + 1/self.preview_rate
+            return True
+
+        def capture_frame()->Union[Frame,None]:
+            # every frame carries the sensor timestamp and metadata of its own exposure
+            start_ns = time.perf_counter_ns()
+            frame = self.frame_source.capture_frame()
+            stage_timings.record('capture_wait',start_ns)
+            if frame is None:
+                return None
+            # crop area defined by detection areat defined in the config, unless the camera already has
+            frame.cropped_image = frame.detect_image if self.frame_source.sensor_crop else \
+                frame.detect_image[upper_left_y:lower_right_y,upper_left_x:lower_right_x]
+            return frame
+
+        def detect_frame(frame: Frame):
+            nonlocal reset_requested
+            if reset_requested:
+                reset_requested = False
+                object_tracking.reset()
+            # drops are counted across skipped frames too so skipping is not mistaken for dropping
+            frame_drops.update(frame)
+            if not scheduler.should_process(frame):
+                frame.skipped = True
+                frame.release_request()
+                return
+            start_ns = time.perf_counter_ns()
+            try:
+                frame.found_object = object_detector.detectObject(frame.cropped_image,frame.metadata,\
+                                                                  object_tracking.state==DetectionState.WAITING)
+                frame.rect = object_detector.rect
+                frame.rects = object_detector.rects
+                frame.ncontours = object_detector.ncontours
+                frame.preview = preview_due()
+                # copy out the main image if needed, everything else goes when the request is released
+                if needs_main_image(frame):
+                    frame.keep_image(frame_pool)
+            finally:
+                frame.release_request()
+            stage_timings.record('detect',start_ns)
+            if frame.image is not None:
+                start_ns = time.perf_counter_ns()
+                annotate_image_for_storage(frame)
+                stage_timings.record('annotate',start_ns)
+            start_ns = time.perf_counter_ns()
             if detection_enabled:
-                object_tracking.update_state(found_object,object_detector.rect,image,frame_timestamp)
-            # show the frame
-            if show_preview:
-                annotate_image_for_preview()
-                cv2.imshow(CarSpeedMonitor.WINDOW_NAME, image)
+                if frame.dropped_before:
+                    object_tracking.note_dropped_frames(frame.dropped_before)
+                object_tracking.update_state(frame.found_object,frame.rect,frame.buffer,frame.timestamp_ns)
+                frame.results = detected_results.copy()
+                detected_results.clear()
+            frame.state_str = object_tracking.getStateStr()
+            frame.live_stats = object_tracking.getLiveStats()
+            scheduler.update(object_tracking.state,frame.ncontours > 0,frame.timestamp_ns)
+            stage_timings.record('track',start_ns)
+
+        def output_frame(frame: Frame):
+            nonlocal frame_count, processed_count, total_contours, num_contours, frame_rate, st, metadata, cpus, cont, detection_enabled, reset_requested, stats_time
+            start_ns = time.perf_counter_ns()
+            for result in frame.results:
+                report_detection(frame,result)
+            if frame.image is not None:
+                # show the frame
+                if show_preview:
+                    # draw on a copy since the frame buffer may also be held as tracking data
+                    preview_image = frame.image.copy()
+                    annotate_image_for_preview(frame,preview_image)
+                    cv2.imshow(CarSpeedMonitor.WINDOW_NAME, preview_image)
+                if frame.preview:
+                    run_preview_hook(frame)
 
-            run_preview_hook()
+            frame_count+=1
+            if not frame.skipped:
+                processed_count+=1
+                total_contours+=frame.ncontours
+            metadata = frame.metadata
+            if frame_count % 20 == 0:
+                ft = time.monotonic()
+                frame_rate=20/(ft-st)
+                num_contours=total_contours/processed_count if processed_count else 0
+                total_contours=0
+                processed_count=0
+                st=time.monotonic()
+                cpus=psutil.cpu_percent(interval=None,percpu=True)
+                cpus.sort(reverse=True)
+                #print(f'Frame rate={frame_rate:3.0f}, avg. contours={num_contours:3.0f}, exp={metadata["ExposureTime"]}, gain=[{metadata["AnalogueGain"]}]      ',end="\r")
+                if st-stats_time > CarSpeedMonitor.STATS_LOG_SECS:
+                    log_stats()
+                    stats_time = st
+
+            # needed to ensure the images in the preview window updated
+            if show_preview:
+                key = cv2.waitKey(1) & 0xFF
+            # process commands from the command hook
+            if command_hook:
+                command = command_hook()
+                if command == Commands.EXIT:
+                    cont=False
+                elif command == Commands.RESET_TRACKING:
+                    reset_requested = True
+                elif command == Commands.TOGGLE_DETECTION:
+                    detection_enabled = not detection_enabled
+            stage_timings.record('hooks',start_ns)
 
-        def run_preview_hook():
+        def run_preview_hook(frame: Frame):
             if preview_hook!=None:
-                stateStr = object_tracking.getStateStr() if cont else "IDLE"
+                stateStr = frame.state_str if cont else "IDLE"
                 exposureTime = metadata["ExposureTime"] if metadata else 0
                 analogueGain = metadata["AnalogueGain"] if metadata else 0
-                state=CarSpeedMonitorState(image,\
+                state=CarSpeedMonitorState(frame.buffer,\
                                             stateStr,\
                                             frame_rate,\
                                             detection_enabled,\
                                             int(num_contours),\
-                                            object_detector._lightlevel,\
+                                            object_detector.get_current_lightlevel(),\
                                             exposureTime,\
                                             analogueGain,
-                                            cpus)
-                preview_hook(state)
+                                            cpus,\
+                                            *frame.live_stats,\
+                                            stage_timings.summary(),\
+                                            get_dropped_frames(),\
+                                            get_queue_depths())
+                # the hook is called from the preview thread so the capture loop never waits on it
+                preview_mailbox.post(state)
+
+        def preview_worker():
+            for state in iter(preview_mailbox.take, None):
+                try:
+                    preview_hook(state)
+                except Exception as e:
+                    logger.logMessage(f"Preview hook failed [{e}]")
+                finally:
+                    state.release()
+
+        def get_dropped_frames()->int:
+            # includes frames the pipeline queues dropped
+            return frame_drops.dropped
+
+        def get_queue_depths()->Dict[str,int]:
+            depths = {q.name: q.depth() for q in queues}
+            if queue_depth_hook:
+                try:
+                    depths.update(queue_depth_hook())
+                except Exception as e:
+                    logger.logMessage(f"Queue depth hook failed [{e}]")
+            return depths
+
+        def log_stats():
+            logger.logMessage("STATS: " + ", ".join([frame_drops.getStatsStr(),scheduler.getStatsStr()] + [q.getStatsStr() for q in queues] + [frame_pool.getStatsStr(),preview_mailbox.getStatsStr(),object_detector.background.getStatsStr()] +\
+                                         ([object_detector.gate.getStatsStr()] if object_detector.gate else [])))
+            depths = ", ".join(f"{name}={depth}" for (name,depth) in get_queue_depths().items())
+            logger.logMessage(f"LATENCY: {stage_timings.getStatsStr()}, dropped={get_dropped_frames()}" + (f", queues {depths}" if depths else ""))
+            # each line covers the time since the one before
+            stage_timings.reset()
+
+        def finish_frame(frame: Frame):
+            nonlocal last_frame
+            # hang on to the last frame with an image for the final preview
+            if frame.image is not None:
+                if last_frame:
+                    last_frame.release()
+                last_frame = frame
+            else:
+                frame.release()
+
+        def capture_worker():
+            nonlocal cont
+            try:
+                while cont:
+                    frame = capture_frame()
+                    if frame is None:
+                        break
+                    dropped = detect_queue.put(frame)
+                    if dropped:
+                        dropped.release()
+            except Exception as e:
+                logger.logMessage(f"Capture stage failed [{e}]")
+                worker_errors.append(e)
+                cont = False
+            finally:
+                detect_queue.put(None,droppable=False)
+
+        def detect_worker():
+            nonlocal cont
+            try:
+                for frame in iter(detect_queue.get, None):
+                    detect_frame(frame)
+                    # frames carrying detections must reach the output stage
+                    dropped = output_queue.put(frame,droppable=not frame.results)
+                    if dropped:
+                        dropped.release()
+            except Exception as e:
+                logger.logMessage(f"Detect stage failed [{e}]")
+                worker_errors.append(e)
+                cont = False
+                # unblock the capture stage and hand back any camera buffers it has queued
+                detect_queue.drop_policy = DropPolicy.DROP_OLDEST
+                for frame in iter(detect_queue.get, None):
+                    frame.release()
+            finally:
+                output_queue.put(None,droppable=False)
 
         def on_key_press(key):
-            nonlocal cont, detection_enabled 
+            nonlocal cont, detection_enabled, reset_requested
             if hasattr(key,'char'):
                 char = key.char
                 # quit
@@ -631,10 +2085,10 @@ class CarSpeedMonitor(object):
                     detection_enabled = not detection_enabled
                 # reset 
                 if char == "r":
-                    object_tracking.reset()
-        
+                    reset_requested = True
+
         def get_pix_area(widthFt: float):
-            width=widthFt/(self.config.getL2RFrameWidthFt())*self.camera.image_width
+            width=widthFt/(self.config.getL2RFrameWidthFt())*self.frame_source.image_width*pixel_scale
             area=width*width
             return area
 
@@ -653,96 +2107,126 @@ class CarSpeedMonitor(object):
         max_speed_save = self.config.max_speed_save
 
         # initialize the camera. Adjust vflip and hflip to reflect your camera's orientation
-        # allow the camera to warm up
-        image_width = self.camera.image_width
-        image_height = self.camera.image_height
-        self.camera.start()
-        time.sleep(0.9)
+        image_width = self.frame_source.image_width
+        image_height = self.frame_source.image_height
+        # detection pixels to each pixel of the full image
+        pixel_scale = self.frame_source.pixel_scale
+        self.frame_source.start()
 
         # create an image window and place it in the upper left corner of the screen
         if show_preview:
             cv2.namedWindow(CarSpeedMonitor.WINDOW_NAME)
             cv2.moveWindow(CarSpeedMonitor.WINDOW_NAME, 10, 40)
-        
+
         cont = True
         if keyboard_avalable:
             listener = keyboard.Listener(
                 on_press=on_key_press)
             listener.start()
 
-                    
-        # this gets called after frame captured but before call capture_array
-        frame_timestamp = datetime.datetime.now()
-        def pre_capture_callback(request):
-            nonlocal frame_timestamp
-            frame_timestamp = datetime.datetime.now()
-        
-        self.camera.picam.pre_callback = pre_capture_callback
         # min width in pixels of a car
         day_min_area=get_pix_area(5)
         # min width in pixels of a car headlamp
         night_min_area=get_pix_area(1)
 
-        object_detector = ObjectDetector(logger,int(day_min_area),int(night_min_area),self.camera)
-        object_tracking = ObjectTracking(logger,self.config,self.camera.image_width,object_detector,moving_object_detected)
-        
+        object_detector = ObjectDetector(logger,int(day_min_area),int(night_min_area),self.frame_source,\
+                                         self.config.background_learning_rate,self.config.background_update_interval,\
+                                         self.config.detect_scale,self.config.blob_backend,self.config.light_meter,\
+                                         self.config.motion_gate)
+        tracking_class = MultiObjectTracking if self.config.tracker=='multi' else ObjectTracking
+        object_tracking = tracking_class(logger,self.config,self.frame_source.image_width,object_detector,moving_object_detected,pixel_scale)
+        detected_results: List[DetectionResult] = []
+
         frame_rate:float=0
         detection_enabled:bool = True
+        reset_requested:bool = False
         frame_count:int=0
+        processed_count:int=0
         total_contours:int=0
         num_contours:float=0
         st:float = time.monotonic()
+        stats_time:float = st
         #
         l2r_m_per_pixel = object_tracking._l2r_ftperpixel * CarSpeedConfig.FT_TO_M
         r2l_m_per_pixel = object_tracking._r2l_ftperpixel * CarSpeedConfig.FT_TO_M
         startMess = f'Monitor started, m per pixel l2r=[{l2r_m_per_pixel:.6f}], r2l=[{r2l_m_per_pixel:.6f}]'
         logger.logMessage(startMess)
         cpus=psutil.cpu_percent(interval=None,percpu=True)
-        metadata = self.camera.picam.capture_metadata()
+        metadata = None
         print(startMess)
-        while cont:
-            # grab the raw NumPy array representing the image 
-            image = self.camera.picam.capture_array('main')
-            # crop area defined by detection areat defined in the config
-            cropped_image = image[upper_left_y:lower_right_y,upper_left_x:lower_right_x]
-            process_image()
-
-            frame_count+=1
-            total_contours+=object_detector.ncontours
-            if frame_count % 20 == 0:
-                ft = time.monotonic()
-                frame_rate=20/(ft-st)
-                num_contours=total_contours/20
-                total_contours=0
-                st=time.monotonic()
-                #if not show_preview:
-                metadata = self.camera.picam.capture_metadata()
-                cpus=psutil.cpu_percent(interval=None,percpu=True)
-                cpus.sort(reverse=True)
-                #print(f'Frame rate={frame_rate:3.0f}, avg. contours={num_contours:3.0f}, exp={metadata["ExposureTime"]}, gain=[{metadata["AnalogueGain"]}]      ',end="\r")
-
-            # needed to ensure the images in the preview window updated
-            if show_preview:
-                key = cv2.waitKey(1) & 0xFF
-            # process commands from the command hook
-            if command_hook:
-                command = command_hook()
-                if command == Commands.EXIT:
-                    cont=False
-                elif command == Commands.RESET_TRACKING:
-                    object_tracking.reset()
-                elif command == Commands.TOGGLE_DETECTION:
-                    detection_enabled = not detection_enabled
-
-        run_preview_hook()            
-        self.camera.stop()
-        # cleanup the camera and close any open windows
-        cv2.destroyAllWindows()
+        last_frame = None
+        queues: List[FrameQueue] = []
+        # raised on this thread once the pipeline has stopped, as they would be without it
+        worker_errors: List[Exception] = []
+        stage_timings = StageTimings()
+        frame_drops = FrameDropCounter(self.frame_source.get_frame_duration_ns())
+        scheduler = ProcessingScheduler(self.frame_source,self.config.idle_decimation,self.config.idle_frame_rate,self.config.active_hold_secs)
+        frame_pool = FramePool(self.config.frame_pool_size,(image_height,image_width,3))
+        next_preview_time:float = 0
+        preview_mailbox = PreviewMailbox()
+        preview_thread = threading.Thread(target=preview_worker,name="CarSpeedPreview")
+        preview_thread.start()
+        # the preview and pipeline threads are not daemons, so they have to be stopped even if a hook raises
+        try:
+            if self.config.pipeline_threads:
+                # capture and detect/track run on their own threads, output stays on this one since the
+                # preview window has to be driven from the main thread
+                drop_policy = DropPolicy[self.config.pipeline_drop_policy.upper()]
+                detect_queue = FrameQueue("capture->detect",self.config.pipeline_queue_size,drop_policy)
+                output_queue = FrameQueue("detect->output",self.config.pipeline_queue_size,drop_policy)
+                queues = [detect_queue, output_queue]
+                threads = [threading.Thread(target=capture_worker,name="CarSpeedCapture"),
+                           threading.Thread(target=detect_worker,name="CarSpeedDetect")]
+                for thread in threads:
+                    thread.start()
+                try:
+                    for frame in iter(output_queue.get, None):
+                        try:
+                            output_frame(frame)
+                        except BaseException:
+                            frame.release()
+                            raise
+                        finish_frame(frame)
+                except BaseException:
+                    # stop the workers and drain the queue they may be blocked on so they can finish
+                    cont = False
+                    for frame in iter(output_queue.get, None):
+                        frame.release()
+                    raise
+                finally:
+                    cont = False
+                    for thread in threads:
+                        thread.join()
+                if worker_errors:
+                    raise worker_errors[0]
+            else:
+                while cont:
+                    frame = capture_frame()
+                    if frame is None:
+                        break
+                    detect_frame(frame)
+                    output_frame(frame)
+                    finish_frame(frame)
+
+            # the final IDLE preview always goes out so the gui sees the monitor has stopped
+            if last_frame:
+                run_preview_hook(last_frame)
+                last_frame.release()
+        finally:
+            preview_mailbox.close()
+            preview_thread.join()
+        object_tracking.reset_tracking(False)
+        log_stats()
+        self.frame_source.stop()
+        # cleanup the camera and close any open windows, headless opencv builds have no window support
+        if show_preview:
+            cv2.destroyAllWindows()
         logger.logMessage("Monitor stopped")
-    
+
     def setConfig(self, config: CarSpeedConfig):
         self.config = config
-        self.camera.set_flip(config.h_flip,config.v_flip)
+        self.frame_source.set_flip(config.h_flip,config.v_flip)
+        self.frame_source.set_streams(config.detect_on_lores,self.get_buffer_count(),self.get_detect_area())
+
 
 
-    
\ No newline at end of file
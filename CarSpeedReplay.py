@@ -0,0 +1,167 @@
+from typing import Iterator, List, Tuple, Union
+from CarSpeedMonitor import CarSpeedCamera, Frame, FrameSource
+from DetectionClip import read_frames
+from pathlib import Path
+from zipfile import ZipFile
+import json
+import re
+import time
+import cv2
+import numpy as np
+
+# frames recorded earlier fed through the monitor in place of the camera, so detection and tracking
+# can be run and profiled away from the pi
+
+class ReplaySource(FrameSource):
+    # subclasses yield (image, timestamp_ns), with the timestamp None if the recording has none. Frames
+    # are resized to the camera's size and given timestamps on the monotonic clock like SensorTimestamp.
+    # realtime paces frames by their timestamps, otherwise they come as fast as the monitor takes them
+    def __init__(self,fps: float=CarSpeedCamera.FRAME_RATE,realtime: bool=False):
+        super().__init__(CarSpeedCamera.IMAGE_WIDTH,CarSpeedCamera.IMAGE_HEIGHT)
+        self.fps = fps
+        self.realtime = realtime
+        self.frame_count = 0
+        self._frames: Union[Iterator[Tuple[np.ndarray,Union[int,None]]],None] = None
+        self._last_timestamp = 0
+        self._start_timestamp = 0
+        self._start_time = 0
+
+    def start(self):
+        self._frames = self.frames()
+        self._start_time = time.monotonic_ns()
+        self._last_timestamp = self._start_timestamp = 0
+
+    def stop(self):
+        if self._frames is not None:
+            self._frames.close()
+            self._frames = None
+
+    def frames(self)->Iterator[Tuple[np.ndarray,Union[int,None]]]:
+        raise NotImplementedError
+
+    def capture_frame(self)->Union[Frame,None]:
+        try:
+            (image,timestamp) = next(self._frames)
+        except StopIteration:
+            return None
+        if image.shape[1]!=self.image_width or image.shape[0]!=self.image_height:
+            image = cv2.resize(image,(self.image_width,self.image_height))
+        if timestamp is None:
+            timestamp = self._start_time + int(self.frame_count*1e9/self.fps)
+        if self.frame_count == 0:
+            self._start_timestamp = timestamp
+        # never let time go backwards, recordings can overlap
+        timestamp = max(timestamp,self._last_timestamp+1)
+        self._last_timestamp = timestamp
+        self.frame_count += 1
+        if self.realtime:
+            wait = (timestamp-self._start_timestamp) - (time.monotonic_ns()-self._start_time)
+            if wait > 0:
+                time.sleep(wait*1e-9)
+        return Frame(image,image,timestamp)
+
+    def get_frame_duration_ns(self)->int:
+        return int(1e9/self.fps)
+
+    @staticmethod
+    def posix_to_monotonic_ns(posix_time: float)->int:
+        # inverse of sensor_to_posix so detections keep their original capture times
+        return int(posix_time*1e9) - (time.time_ns() - time.monotonic_ns())
+
+    @staticmethod
+    def frame_times(detection: dict)->List[int]:
+        # timestamps of a detection's tracking images, the result is timed by the last of them
+        tracking_data = detection.get('tracking_data',[])
+        if not tracking_data:
+            return []
+        end = ReplaySource.posix_to_monotonic_ns(detection['posix_time'])
+        last_secs = tracking_data[-1]['secs']
+        return [end - int((last_secs - td['secs'])*1e9) for td in tracking_data]
+
+    @staticmethod
+    def natural_key(path: Path):
+        # 2.jpg before 10.jpg
+        return [int(s) if s.isdigit() else s for s in re.split(r'(\d+)',path.name)]
+
+class VideoFileSource(ReplaySource):
+    # any file opencv can read, timed by the position in the video
+    def __init__(self,filename: str,fps: float=CarSpeedCamera.FRAME_RATE,realtime: bool=False,use_video_time: bool=True):
+        super().__init__(fps,realtime)
+        self.filename = filename
+        self.use_video_time = use_video_time
+
+    def frames(self)->Iterator[Tuple[np.ndarray,Union[int,None]]]:
+        capture = cv2.VideoCapture(self.filename)
+        if not capture.isOpened():
+            raise ValueError(f"Unable to open video [{self.filename}]")
+        try:
+            while True:
+                (ok,image) = capture.read()
+                if not ok:
+                    break
+                timestamp = None
+                if self.use_video_time:
+                    msecs = capture.get(cv2.CAP_PROP_POS_MSEC)
+                    if msecs > 0:
+                        timestamp = self._start_time + int(msecs*1e6)
+                yield (image,timestamp)
+        finally:
+            capture.release()
+
+class JpegDirectorySource(ReplaySource):
+    # numbered jpgs, e.g. the tracking images DetectionSaver writes. If there is a json file of the same
+    # name alongside the directory its tracking data times the frames, otherwise they are fps apart
+    def __init__(self,folder: str,fps: float=CarSpeedCamera.FRAME_RATE,realtime: bool=False):
+        super().__init__(fps,realtime)
+        self.folder = Path(folder)
+
+    def frames(self)->Iterator[Tuple[np.ndarray,Union[int,None]]]:
+        filenames = sorted(list(self.folder.glob('*.jpg'))+list(self.folder.glob('*.jpeg')),key=ReplaySource.natural_key)
+        times: List[int] = []
+        json_path = self.folder.with_suffix('.json')
+        if json_path.exists():
+            with open(json_path) as f:
+                times = ReplaySource.frame_times(json.load(f))
+        if len(times)!=len(filenames):
+            times = []
+        for (index,filename) in enumerate(filenames):
+            image = cv2.imread(str(filename))
+            if image is None:
+                continue
+            yield (image,times[index] if times else None)
+
+class DetectionZipSource(ReplaySource):
+    # the zips DetectionUploader.saveZipfile writes, in any payload, one file or every zip under a folder in
+    # name (so time) order. Frames are timed from the tracking data. The images were annotated before they were saved,
+    # so expect the drawn rects to show up as motion
+    def __init__(self,path: str,fps: float=CarSpeedCamera.FRAME_RATE,realtime: bool=False):
+        super().__init__(fps,realtime)
+        self.path = Path(path)
+
+    def zipfiles(self)->List[Path]:
+        if self.path.is_dir():
+            return sorted(self.path.rglob('*.zip'))
+        return [self.path]
+
+    def frames(self)->Iterator[Tuple[np.ndarray,Union[int,None]]]:
+        for zip_path in self.zipfiles():
+            with ZipFile(zip_path) as myzip:
+                names = myzip.namelist()
+                json_names = [n for n in names if n.endswith('detection_data.json')]
+                times: List[int] = []
+                if json_names:
+                    times = ReplaySource.frame_times(json.loads(myzip.read(json_names[0])))
+                # frames are numbered by their tracking data, keyframe payloads leave some out
+                for (index,image) in read_frames(myzip):
+                    yield (image,times[index] if index < len(times) else None)
+
+def open_replay_source(path: str,fps: float=CarSpeedCamera.FRAME_RATE,realtime: bool=False)->ReplaySource:
+    # picks the source from what path is
+    p = Path(path)
+    if p.is_dir():
+        if any(p.rglob('*.zip')):
+            return DetectionZipSource(path,fps,realtime)
+        return JpegDirectorySource(path,fps,realtime)
+    if p.suffix.lower()=='.zip':
+        return DetectionZipSource(path,fps,realtime)
+    return VideoFileSource(path,fps,realtime)
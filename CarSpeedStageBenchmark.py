@@ -0,0 +1,167 @@
+from typing import Callable, Dict, List, Tuple
+from CarSpeedMonitor import FrameSource, LightMeter, Logger, MotionGate, ObjectDetector
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import time
+import cv2
+import numpy as np
+
+# times each step of the detection hot path on its own, across monitored area sizes and numbers
+# of moving blobs, and writes the results as json so runs on different commits and pis compare
+
+DEFAULT_ROIS = [(160,96),(320,190),(450,250),(640,380)]
+DEFAULT_BLOBS = [0,20,100,400]
+
+def time_stage(fn: Callable[[],object],repeat: int)->Dict[str,float]:
+    # a few untimed runs first so caches and opencv's lazy initialisation are out of the way
+    for _ in range(3):
+        fn()
+    times = np.empty(repeat)
+    for i in range(repeat):
+        start = time.perf_counter_ns()
+        fn()
+        times[i] = time.perf_counter_ns() - start
+    times /= 1000
+    return {'mean_us': float(times.mean()),
+            'median_us': float(np.median(times)),
+            'p90_us': float(np.percentile(times,90)),
+            'min_us': float(times.min())}
+
+def make_frames(roi: Tuple[int,int],blobs: int,seed: int=0)->Tuple[np.ndarray,np.ndarray]:
+    # a textured empty scene and the same scene with blobs big and bright enough to survive the blur
+    (width,height) = roi
+    rng = np.random.default_rng(seed)
+    background = np.clip(rng.normal(100,6,(height,width,3)),0,255).astype(np.uint8)
+    frame = background.copy()
+    for _ in range(blobs):
+        x = int(rng.integers(0,max(1,width-12)))
+        y = int(rng.integers(0,max(1,height-12)))
+        cv2.rectangle(frame,(x,y),(x+10,y+10),(230,230,230),-1)
+    return (background,frame)
+
+def make_detector(blob_backend: str='components',detect_scale: int=1)->ObjectDetector:
+    detector = ObjectDetector(Logger(lambda message: None),7000,300,FrameSource(640,380),\
+                              detect_scale=detect_scale,blob_backend=blob_backend)
+    detector._adjusted_threshold = ObjectDetector.THRESHOLD
+    return detector
+
+def annotate_storage(image: np.ndarray,rects: List[Tuple[int,int,int,int]]):
+    # the drawing annotate_image_for_storage in CarSpeedMonitor.start does on every kept frame
+    cv2.putText(image, datetime.datetime.now().strftime("%A %d %B %Y %I:%M:%S%p"),
+        (10, image.shape[0] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (0, 255, 0), 1)
+    cv2.rectangle(image,(50,50),(500,300),(0, 255, 0))
+    for (x,y,w,h) in rects:
+        cv2.rectangle(image,(x+50,y+50),(x+50+w,y+50+h),(255, 0, 0))
+
+def annotate_detection(image: np.ndarray,mean_speed: float):
+    # the drawing annotate_main_image in CarSpeedMonitor.start does on each detection
+    cv2.putText(image, datetime.datetime.now().strftime("%A %d %B %Y %I:%M:%S%p"),
+        (10, image.shape[0] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (0, 255, 0), 1)
+    size, base = cv2.getTextSize( "%.0f mph" % mean_speed, cv2.FONT_HERSHEY_SIMPLEX, 2, 3)
+    cntr_x = int((image.shape[1] - size[0]) / 2)
+    cv2.putText(image, "%.0f mph" % mean_speed,
+        (cntr_x , int(image.shape[0] * 0.2)), cv2.FONT_HERSHEY_SIMPLEX, 2.00, (0, 255, 0), 3)
+
+def benchmark_case(roi: Tuple[int,int],blobs: int,repeat: int)->Dict[str,object]:
+    (background,frame) = make_frames(roi,blobs)
+    detector = make_detector()
+    # each stage is fed the output of the one before, as detectObject does
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    blurred = cv2.GaussianBlur(gray, ObjectDetector.BLURSIZE, 0)
+    base_gray = cv2.GaussianBlur(cv2.cvtColor(background, cv2.COLOR_BGR2GRAY), ObjectDetector.BLURSIZE, 0)
+    base_float = base_gray.astype("float")
+    delta = cv2.absdiff(blurred, base_gray)
+    thresh = cv2.threshold(delta, ObjectDetector.THRESHOLD, 255, cv2.THRESH_BINARY)[1]
+    dilated = cv2.dilate(thresh, None, iterations=2)
+    (rects,ncontours) = detector._find_blob_components(dilated)
+    detector.background.rebuild(base_gray)
+    light_meter = LightMeter()
+    full_frame = np.zeros((380,640,3),dtype=np.uint8)
+    # changes the thresholds so keep it away from the detector the other stages use
+    light_detector = make_detector()
+    light_detector.light_meter.measure(frame)
+    gate = MotionGate()
+    gate.check(background,ObjectDetector.THRESHOLD,7000)
+
+    def update_lightlevel():
+        # it prints every update
+        with contextlib.redirect_stdout(io.StringIO()):
+            light_detector.update_lightlevel(base_gray)
+
+    stages = {
+        'gray_convert': lambda: cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY),
+        'gaussian_blur': lambda: cv2.GaussianBlur(gray, ObjectDetector.BLURSIZE, 0),
+        'convert_scale_abs': lambda: cv2.convertScaleAbs(base_float),
+        'absdiff': lambda: cv2.absdiff(blurred, base_gray),
+        'threshold': lambda: cv2.threshold(delta, ObjectDetector.THRESHOLD, 255, cv2.THRESH_BINARY),
+        'dilate': lambda: cv2.dilate(thresh, None, iterations=2),
+        'find_contours': lambda: detector._find_blob_contours(dilated),
+        'connected_components': lambda: detector._find_blob_components(dilated),
+        'background_update': lambda: detector.background.update(blurred),
+        'light_meter': lambda: light_meter.measure(frame),
+        'motion_gate': lambda: gate.check(frame,ObjectDetector.THRESHOLD,7000),
+        'update_lightlevel': update_lightlevel,
+        'annotate_storage': lambda: annotate_storage(full_frame,rects),
+        'annotate_detection': lambda: annotate_detection(full_frame,30),
+    }
+    for scale in (2,4):
+        reducer = make_detector(detect_scale=scale)
+        stages[f'reduce_x{scale}'] = lambda reducer=reducer: reducer._reduce(gray)
+    results = {name: time_stage(fn,repeat) for (name,fn) in stages.items()}
+    # and the whole of detectObject for each way of running it
+    for backend in ('contours','components'):
+        for scale in (1,2):
+            full = make_detector(backend,scale)
+            with contextlib.redirect_stdout(io.StringIO()):
+                full.detectObject(background)
+            results[f'detect_object_{backend}_x{scale}'] = time_stage(lambda: full.detectObject(frame),repeat)
+    return {'roi': list(roi), 'blobs': blobs, 'ncontours': ncontours, 'stages': results}
+
+def platform_info()->Dict[str,str]:
+    info = {'machine': platform.machine(),
+            'system': platform.platform(),
+            'python': platform.python_version(),
+            'opencv': cv2.__version__,
+            'numpy': np.__version__,
+            'cpus': str(cv2.getNumberOfCPUs())}
+    try:
+        # the pi model is the last line of cpuinfo
+        with open('/proc/cpuinfo') as f:
+            models = [line.split(':',1)[1].strip() for line in f if line.startswith('Model') or line.startswith('model name')]
+        if models:
+            info['model'] = models[-1]
+    except OSError:
+        pass
+    try:
+        info['commit'] = subprocess.run(['git','rev-parse','--short','HEAD'],capture_output=True,text=True,check=True,\
+                                        cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError,subprocess.CalledProcessError):
+        pass
+    return info
+
+def run_stage_benchmark(rois: List[Tuple[int,int]],blobs: List[int],repeat: int)->Dict[str,object]:
+    return {'platform': platform_info(),
+            'repeat': repeat,
+            'results': [benchmark_case(roi,n,repeat) for roi in rois for n in blobs]}
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Times each stage of the detection hot path")
+    ap.add_argument("--roi", action='append', metavar="WIDTHxHEIGHT", help="Monitored area size, can be repeated")
+    ap.add_argument("--blobs", action='append', type=int, help="Moving blobs in the frame, can be repeated")
+    ap.add_argument("--repeat", type=int, default=200, help="Timed runs of each stage")
+    ap.add_argument("--json", help="Write the results to this file rather than stdout")
+    args = vars(ap.parse_args())
+
+    rois = [tuple(int(v) for v in roi.lower().split('x')) for roi in args["roi"]] if args["roi"] else DEFAULT_ROIS
+    report = run_stage_benchmark(rois,args["blobs"] or DEFAULT_BLOBS,args["repeat"])
+    if args["json"]:
+        with open(args["json"],'w') as f:
+            json.dump(report,f,indent=4)
+    else:
+        print(json.dumps(report,indent=4))
@@ -0,0 +1,171 @@
+from typing import Iterator, List, Tuple, Union
+from CarSpeedConfig import CarSpeedConfig
+from CarSpeedMonitor import CarSpeedCamera, DetectionDirection, sensor_to_posix
+from CarSpeedReplay import ReplaySource
+import math
+import cv2
+import numpy as np
+
+# synthetic traffic with known speeds, for measuring how detection and tracking hold up as
+# the traffic, the light and the weather change
+
+MPH_TO_FPS = 1/0.681818    # same magic number ObjectTracking uses
+
+class SyntheticVehicle(object):
+    # one vehicle crossing the frame at a constant speed, entering at start_secs
+    def __init__(self,start_secs: float,direction: DetectionDirection,speed_mph: float,length_m: float=4.5):
+        self.start_secs = start_secs
+        self.direction = direction
+        self.speed_mph = speed_mph
+        self.length_m = length_m
+
+class SyntheticScene(object):
+    # how the scene looks, light 1.0 is a bright day and below about 0.3 vehicles show headlights only
+    def __init__(self,light: float=1.0,noise: float=2.0,drift: float=0.0,drift_period_secs: float=60,rain: int=0,seed: int=0):
+        self.light = light
+        # sd of the sensor noise in grey levels
+        self.noise = noise
+        # fraction the brightness swings by over drift_period_secs
+        self.drift = drift
+        self.drift_period_secs = drift_period_secs
+        # rain streaks per frame
+        self.rain = rain
+        self.seed = seed
+
+    def is_night(self)->bool:
+        return self.light < 0.3
+
+class SyntheticTraffic(object):
+    # the vehicles that make up a run
+    def __init__(self,vehicles: List[SyntheticVehicle],duration_secs: float):
+        self.vehicles = sorted(vehicles,key=lambda v: v.start_secs)
+        self.duration_secs = duration_secs
+
+    @staticmethod
+    def random(duration_secs: float,vehicles_per_minute: float,min_mph: float=15,max_mph: float=45,\
+               min_length_m: float=3.5,max_length_m: float=6,start_secs: float=2,seed: int=0)->'SyntheticTraffic':
+        # arrivals are a poisson process in each direction, so busy runs get vehicles close together
+        rng = np.random.default_rng(seed)
+        vehicles = []
+        for direction in (DetectionDirection.LEFT_TO_RIGHT,DetectionDirection.RIGHT_TO_LEFT):
+            t = start_secs
+            while vehicles_per_minute > 0:
+                t += rng.exponential(120/vehicles_per_minute)
+                if t >= duration_secs:
+                    break
+                vehicles.append(SyntheticVehicle(t,direction,rng.uniform(min_mph,max_mph),rng.uniform(min_length_m,max_length_m)))
+        return SyntheticTraffic(vehicles,duration_secs)
+
+class SyntheticTrafficSource(ReplaySource):
+    # renders the traffic in the lanes the config's distances imply, vehicles move exactly as many pixels
+    # per frame as their speed gives with the config's ft per pixel
+    NOISE_FRAMES = 16
+
+    def __init__(self,config: CarSpeedConfig,traffic: SyntheticTraffic,scene: SyntheticScene=SyntheticScene(),\
+                 fps: float=CarSpeedCamera.FRAME_RATE,realtime: bool=False):
+        super().__init__(fps,realtime)
+        self.config = config
+        self.traffic = traffic
+        self.scene = scene
+        self._rng = np.random.default_rng(scene.seed)
+        ma = config.monitor_area
+        self._area = (ma.upper_left_x,ma.upper_left_y,ma.lower_right_x,ma.lower_right_y)
+        self._ftperpixel = {DetectionDirection.LEFT_TO_RIGHT: config.getL2RFrameWidthFt()/float(self.image_width),
+                            DetectionDirection.RIGHT_TO_LEFT: config.getR2LFrameWidthFt()/float(self.image_width)}
+        self._background = self._render_background()
+        # noise is generated up front and cycled, generating it per frame would swamp the timings
+        self._noise = [self._rng.normal(0,scene.noise,(self.image_height,self.image_width,1)).astype(np.float32)\
+                       for _ in range(SyntheticTrafficSource.NOISE_FRAMES)] if scene.noise > 0 else []
+
+    def pixels_per_sec(self,vehicle: SyntheticVehicle)->float:
+        return vehicle.speed_mph*MPH_TO_FPS/self._ftperpixel[vehicle.direction]
+
+    def length_pixels(self,vehicle: SyntheticVehicle)->int:
+        return int(vehicle.length_m*CarSpeedConfig.M_TO_FT/self._ftperpixel[vehicle.direction])
+
+    def lane(self,direction: DetectionDirection)->Tuple[int,int]:
+        # top and bottom of the vehicles in a lane, left to right is the lane further away
+        (_,y1,_,y2) = self._area
+        centre = y1 + (y2-y1)*(0.4 if direction==DetectionDirection.LEFT_TO_RIGHT else 0.7)
+        height = (y2-y1)*(0.25 if direction==DetectionDirection.LEFT_TO_RIGHT else 0.3)
+        return (int(centre-height/2),int(centre+height/2))
+
+    def position(self,vehicle: SyntheticVehicle,secs: float)->Tuple[float,int]:
+        # left edge and length in pixels
+        length = self.length_pixels(vehicle)
+        moved = self.pixels_per_sec(vehicle)*(secs - vehicle.start_secs)
+        if vehicle.direction==DetectionDirection.LEFT_TO_RIGHT:
+            return (-length + moved,length)
+        return (self.image_width - moved,length)
+
+    def exit_secs(self,vehicle: SyntheticVehicle)->float:
+        # when the front of the vehicle reaches the far side of the monitored area
+        (x1,_,x2,_) = self._area
+        length = self.length_pixels(vehicle)
+        if vehicle.direction==DetectionDirection.LEFT_TO_RIGHT:
+            distance = x2 + length
+        else:
+            distance = self.image_width - x1
+        return vehicle.start_secs + distance/self.pixels_per_sec(vehicle)
+
+    def scene_to_posix(self,secs: float)->float:
+        # frames are fps apart from start, as ReplaySource times frames without timestamps
+        return sensor_to_posix(self._start_time + int(secs*1e9))
+
+    def frames(self)->Iterator[Tuple[np.ndarray,Union[int,None]]]:
+        frame_count = int(self.traffic.duration_secs*self.fps)
+        for index in range(frame_count):
+            yield (self.render(index/self.fps,index),None)
+
+    def render(self,secs: float,index: int=0)->np.ndarray:
+        scene = self.scene
+        image = self._background.copy()
+        visible = []
+        for vehicle in self.traffic.vehicles:
+            if vehicle.start_secs > secs:
+                break
+            (x,length) = self.position(vehicle,secs)
+            if x+length < 0 or x > self.image_width:
+                continue
+            visible.append((vehicle,int(round(x)),length))
+            if not scene.is_night():
+                self._draw_vehicle(image,vehicle,int(round(x)),length)
+        for _ in range(scene.rain):
+            # short bright streaks falling slightly to one side
+            x = int(self._rng.integers(0,self.image_width))
+            y = int(self._rng.integers(0,self.image_height))
+            cv2.line(image,(x,y),(x+2,y+12),(200,200,200),1)
+        gain = scene.light*(1 + scene.drift*math.sin(2*math.pi*secs/scene.drift_period_secs))
+        if self._noise or gain != 1.0:
+            frame = image.astype(np.float32)*gain
+            if self._noise:
+                frame += self._noise[index % len(self._noise)]
+            image = np.clip(frame,0,255).astype(np.uint8)
+        if scene.is_night():
+            # headlights are not dimmed by the light level
+            for (vehicle,x,length) in visible:
+                self._draw_headlights(image,vehicle,x,length)
+        return image
+
+    def _render_background(self)->np.ndarray:
+        # road, verge and a little texture so the background is not flat
+        image = np.empty((self.image_height,self.image_width,3),dtype=np.uint8)
+        image[:] = (70,110,80)
+        (l2r_top,_) = self.lane(DetectionDirection.LEFT_TO_RIGHT)
+        (_,r2l_bottom) = self.lane(DetectionDirection.RIGHT_TO_LEFT)
+        cv2.rectangle(image,(0,l2r_top-10),(self.image_width,r2l_bottom+10),(95,95,95),-1)
+        texture = self._rng.integers(-8,8,(self.image_height,self.image_width,1))
+        return np.clip(image.astype(np.int16)+texture,0,255).astype(np.uint8)
+
+    def _draw_headlights(self,image: np.ndarray,vehicle: SyntheticVehicle,x: int,length: int):
+        (top,bottom) = self.lane(vehicle.direction)
+        front = x+length if vehicle.direction==DetectionDirection.LEFT_TO_RIGHT else x
+        for y in (top+(bottom-top)//3,top+2*(bottom-top)//3):
+            cv2.circle(image,(front,y),max(3,(bottom-top)//8),(255,255,255),-1)
+
+    def _draw_vehicle(self,image: np.ndarray,vehicle: SyntheticVehicle,x: int,length: int):
+        (top,bottom) = self.lane(vehicle.direction)
+        colour = tuple(int(c) for c in (np.array([160,160,170])+40*math.sin(vehicle.start_secs)))
+        cv2.rectangle(image,(x,top),(x+length,bottom),colour,-1)
+        # windows
+        cv2.rectangle(image,(x+length//4,top+2),(x+3*length//4,top+(bottom-top)//3),(60,60,60),-1)
@@ -1,9 +1,12 @@
 import platform
 import signal
 import threading
-from CarSpeedMonitor import CarSpeedMonitor, CarSpeedMonitorState, Commands, DetectionResult
+from CarSpeedMonitor import CarSpeedCamera, CarSpeedMonitor, CarSpeedMonitorState, Commands, DetectionResult, FrameBuffer
 from CarSpeedConfig import CarSpeedConfig
 from SignalRHandler import SignalRHandler
+from SharedFrameRing import FrameDescriptor, SharedFrameRing
+from DetectionClip import ClipOptions, encode_frames
+from UploadSpool import UploadSpool
 from datetime import date
 from datetime import datetime
 from pathlib import Path
@@ -14,89 +17,197 @@ import time
 from zipfile import ZipFile
 import requests
 from multiprocessing import Process, Queue
+from concurrent.futures import ThreadPoolExecutor
 from signalrcore.hub_connection_builder import HubConnectionBuilder
 from signalrcore.protocol.messagepack_protocol import MessagePackHubProtocol
+from typing import Dict, List, Tuple, Union
 import logging
 
+FRAME_SLOT_SIZE = CarSpeedCamera.IMAGE_WIDTH*CarSpeedCamera.IMAGE_HEIGHT*3
+
+def shareImage(frameRing: SharedFrameRing, holder)->Union[FrameDescriptor,None]:
+    # move the image of a DetectionResult, TrackingData or CarSpeedMonitorState into shared memory
+    # so it is not pickled, returns None if it has to go the old way
+    if holder.image is None:
+        return None
+    desc = frameRing.write(holder.image)
+    if desc:
+        # only hand back the holder's own image, a result's tracking data is shared separately
+        if isinstance(holder,DetectionResult):
+            holder.release_image()
+        else:
+            holder.release()
+    return desc
+
+def attachImage(frameRing: SharedFrameRing, holder, desc: Union[FrameDescriptor,None]):
+    if desc:
+        holder.set_image(FrameBuffer(frameRing.read(desc)))
+
+def queueDepth(q: Queue)->int:
+    # qsize is approximate and not implemented on every platform
+    try:
+        return q.qsize()
+    except NotImplementedError:
+        return -1
+
 class DetectionUploader:
+    RING_SLOTS = 64
+    # imencode releases the GIL so a detection's frames are encoded in parallel
+    ENCODE_THREADS = 3
+    # zips are saved here, under a folder per day, until they have been uploaded
+    FOLDER = 'detections'
+    # seconds to wait for the server to accept a connection and then to respond
+    CONNECT_TIMEOUT = 5
+    READ_TIMEOUT = 60
     def __init__(self,rootUrl:str,configId:int):
         self.uploadQueue = Queue()
         self.rootUrl = rootUrl
-        self.process = Process(target=DetectionUploader.uploadWorker,args=[self.uploadQueue,rootUrl,])        
+        self.frameRing = SharedFrameRing(DetectionUploader.RING_SLOTS,FRAME_SLOT_SIZE)
+        self.process = Process(target=DetectionUploader.uploadWorker,args=[self.uploadQueue,rootUrl,self.frameRing,])        
         self.process.start()
     
-    def upload(self,result: DetectionResult):
-        self.uploadQueue.put(result)
+    def upload(self,result: DetectionResult,options: ClipOptions=ClipOptions()):
+        # images are borrowed from the monitor's frame pool, copy them into the shared ring and only
+        # send descriptors. Anything that doesn't fit is detached and pickled as before
+        descs = [shareImage(self.frameRing,result)] + [shareImage(self.frameRing,td) for td in result.tracking_data]
+        self.uploadQueue.put((result.detach(),descs,options))
+
+    def depth(self)->int:
+        return queueDepth(self.uploadQueue)
     
     def stop(self):
         self.uploadQueue.put('STOP')
+        self.process.join()
+        self.frameRing.close()
+        self.frameRing.unlink()
     
     @staticmethod
-    def saveZipfile(result: DetectionResult)->str:
+    def encodeJpg(image)->bytes:
+        return cv2.imencode('.jpg', image)[1]
+
+    @staticmethod
+    def encodeImages(result: DetectionResult, executor: Union[ThreadPoolExecutor,None]=None, options: ClipOptions=ClipOptions())->Tuple[Union[bytes,None],Dict[str,bytes]]:
+        # jpg of the main image (if any) and the tracking frames in the payload asked for
+        if result.image is None or executor is None:
+            mainJpg = None if result.image is None else DetectionUploader.encodeJpg(result.image)
+            return (mainJpg,encode_frames(result.tracking_data,options,executor,DetectionUploader.encodeJpg))
+        # the main image is encoded alongside the tracking frames
+        mainJpg = executor.submit(DetectionUploader.encodeJpg,result.image)
+        members = encode_frames(result.tracking_data,options,executor,DetectionUploader.encodeJpg)
+        return (mainJpg.result(),members)
+
+    @staticmethod
+    def saveZipfile(result: DetectionResult, encoded: Union[Tuple[Union[bytes,None],Dict[str,bytes]],None]=None)->str:
+        # encodes the images itself unless given them already encoded by encodeImages
+        if encoded is None:
+            encoded = DetectionUploader.encodeImages(result)
+        (mainJpg,members) = encoded
         cap_time = datetime.fromtimestamp(result.posix_time)
         # and save the image to disk
-        folder = f'detections/{cap_time.year:04}-{cap_time.month:02}-{cap_time.day:02}'
+        folder = f'{DetectionUploader.FOLDER}/{cap_time.year:04}-{cap_time.month:02}-{cap_time.day:02}'
         folderPath = Path(folder)
         if not folderPath.is_dir():
             os.makedirs(folder)        
         fileRoot = folder + "/detection_" + cap_time.strftime("%Y-%m-%d_%H-%M-%S")   
 
-        # save to zip file
+        # save to zip file, an earlier detection in the same second may still be waiting to upload
         zipFilename = fileRoot + '.zip'
-        with ZipFile(zipFilename, 'w') as myzip:
+        suffix = 1
+        while Path(zipFilename).exists():
+            zipFilename = f"{fileRoot}_{suffix}.zip"
+            suffix += 1
+        # written to the side and renamed so the spool never finds a partly written zip
+        with ZipFile(zipFilename + '.part', 'w') as myzip:
             jsonFilename=f"{fileRoot}/detection_data.json"
             myzip.writestr(jsonFilename,result.toJson())
-            if not result.image is None:
+            if not mainJpg is None:
                 imageFilename =  f"{fileRoot}/detection_image.jpg";
-                jpgData = cv2.imencode('.jpg', result.image)[1]
-                myzip.writestr(imageFilename,jpgData)
-            index=0
-            for td in result.tracking_data:
-                imageFilename = f"{fileRoot}/{index}.jpg"
-                jpgData = cv2.imencode('.jpg', td.image)[1]
-                myzip.writestr(imageFilename,jpgData)
-                index+=1
+                myzip.writestr(imageFilename,mainJpg)
+            for (name,data) in members.items():
+                myzip.writestr(f"{fileRoot}/{name}",data)
+        os.replace(zipFilename + '.part',zipFilename)
 
         return zipFilename
 
     @staticmethod
-    def uploadZipfile(fn,rootUrl: str):
-        # upload to website
-        uploaded = False
+    def uploadZipfile(fn,rootUrl: str)->int:
+        # upload to website, the spool retries failures and removes the zip once it is uploaded
         with open(fn, 'rb') as f:
             files = {"file": f}
-            try:
-                r = requests.post(f"{rootUrl}/Detections/Upload", files=files)
-                if r.status_code==200:
-                    uploaded = True
-                else:
-                    print(f"Invalid status code uploaded detection [{r.status_code}]");
-            except:
-                print(f"Problem uploading detection")                
-        if uploaded:
-            os.remove(fn)
+            r = requests.post(f"{rootUrl}/Detections/Upload", files=files,\
+                              timeout=(DetectionUploader.CONNECT_TIMEOUT,DetectionUploader.READ_TIMEOUT))
+        return r.status_code
         
     @staticmethod
-    def uploadWorker(q: Queue, rootUrl: str):
-        for dr in iter(q.get, 'STOP'):
-            fn = DetectionUploader.saveZipfile(dr)
-            DetectionUploader.uploadZipfile(fn,rootUrl)
+    def uploadWorker(q: Queue, rootUrl: str, frameRing: SharedFrameRing):
+        # detections are encoded and zipped here while the spool uploads them, along with any left
+        # over from before a restart or a server outage
+        spool = UploadSpool(DetectionUploader.FOLDER,lambda fn: DetectionUploader.uploadZipfile(fn,rootUrl))
+        spool.start()
+        try:
+            with ThreadPoolExecutor(DetectionUploader.ENCODE_THREADS) as executor:
+                for (dr,descs,options) in iter(q.get, 'STOP'):
+                    try:
+                        DetectionUploader.spoolDetection(dr,descs,options,frameRing,executor,spool,queueDepth(q))
+                    except Exception as e:
+                        # lose this detection rather than every one after it
+                        print(f"Problem saving detection [{e}]")
+        finally:
+            # the spool's thread would keep the process alive
+            spool.stop()
+
+    @staticmethod
+    def spoolDetection(dr: DetectionResult, descs: List[Union[FrameDescriptor,None]], options: ClipOptions, frameRing: SharedFrameRing,\
+                       executor: ThreadPoolExecutor, spool: UploadSpool, waiting: int):
+        st:float = time.monotonic()
+        holders = [dr] + dr.tracking_data
+        try:
+            for (holder,desc) in zip(holders,descs):
+                attachImage(frameRing,holder,desc)
+            encoded = DetectionUploader.encodeImages(dr,executor,options)
+        finally:
+            # finished with the shared images so hand the slots back
+            for holder in holders:
+                holder.set_image(None)
+            frameRing.free(descs)
+        et:float = time.monotonic()
+        fn = DetectionUploader.saveZipfile(dr,encoded)
+        zt:float = time.monotonic()
+        size = os.path.getsize(fn)
+        spool.add(fn)
+        print(f"SPOOLED: [{fn}] {size//1024}KB encoded in {et-st:.3f}s, zipped in {zt-et:.3f}s, "\
+              f"detections waiting={waiting}, {spool.getStatsStr()}")
 
 class PreviewUploader:
+    RING_SLOTS = 2
     def __init__(self,rootUrl:str,monitorName:str):
         self.uploadQueue = Queue()
-        self.process = Process(target=PreviewUploader.uploadWorker,args=[self.uploadQueue,rootUrl,monitorName,])
+        self.frameRing = SharedFrameRing(PreviewUploader.RING_SLOTS,FRAME_SLOT_SIZE)
+        self.process = Process(target=PreviewUploader.uploadWorker,args=[self.uploadQueue,rootUrl,monitorName,self.frameRing,])
         self.process.start()
     
     def uploadPreview(self,result:CarSpeedMonitorState):
         # always send if state idle since only one of these is sent and it needs to get through for the state to change in the gui
         if self.uploadQueue.empty() or result.state=='IDLE':
-            self.uploadQueue.put(result)
+            # the frame goes across in shared memory and is encoded by the uploader process
+            desc = shareImage(self.frameRing,result)
+            if desc is None:
+                # ring full, only the IDLE state has to get through
+                if result.state!='IDLE':
+                    return
+                result.detach()
+            self.uploadQueue.put((result,desc))
         else:
             pass
+
+    def depth(self)->int:
+        return queueDepth(self.uploadQueue)
     
     def stop(self):
         self.uploadQueue.put('STOP')
+        self.process.join()
+        self.frameRing.close()
+        self.frameRing.unlink()
             
     @staticmethod
     def _uploadWorker(q: Queue):
@@ -104,12 +215,14 @@ class PreviewUploader:
             print(fn)
 
     @staticmethod
-    def uploadWorker(q: Queue,rootUrl:str,monitorName:str):
+    def uploadWorker(q: Queue,rootUrl:str,monitorName:str,frameRing: SharedFrameRing):
         signalRHandler = SignalRHandler(rootUrl,monitorName)
         signalRHandler.start()
-        for state in iter(q.get, 'STOP'):
+        for (state,desc) in iter(q.get, 'STOP'):
             st:float = time.monotonic()
+            attachImage(frameRing,state,desc)
             state.generateJpg()
+            frameRing.free([desc])
             signalRHandler.uploadPreview(state)
             ft=time.monotonic()
         signalRHandler.stop()
@@ -123,6 +236,9 @@ class MessageUploader:
     def uploadMessage(self,mess:str):
         self.uploadQueue.put(mess)
 
+    def depth(self)->int:
+        return queueDepth(self.uploadQueue)
+
     def stop(self):
         self.uploadQueue.put('STOP')
             
@@ -149,7 +265,12 @@ def main():
     def car_detected(result: DetectionResult):
         if detectionUploader and config:
             result.configId=config.id
-            detectionUploader.upload(result)
+            detectionUploader.upload(result,clipOptions())
+
+    def clipOptions()->ClipOptions:
+        ma = config.monitor_area
+        area = (ma.upper_left_x,ma.upper_left_y,ma.lower_right_x-ma.upper_left_x,ma.lower_right_y-ma.upper_left_y)
+        return ClipOptions(config.detection_payload,config.detection_keyframes,area,proc.frame_source.pixel_scale)
 
     def preview_available(state:CarSpeedMonitorState):
         if previewUploader:
@@ -158,13 +279,18 @@ def main():
     def logMessage(mess: str):
         if messageUploader:
             messageUploader.uploadMessage(mess)
+
+    def queueDepths()->dict:
+        # reported alongside the monitor's own queues so a backed up uploader shows on the dashboard
+        uploaders = {'detection_upload': detectionUploader, 'preview_upload': previewUploader, 'message_upload': messageUploader}
+        return {name: uploader.depth() for (name,uploader) in uploaders.items() if uploader}
     
     def start():
         nonlocal running
         while(not exitProgram and config):
             running = True
             proc.setConfig(config)
-            proc.start(detection_hook=car_detected,command_hook=processCommand,preview_hook=preview_available,logger_hook=logMessage,show_preview=False)
+            proc.start(detection_hook=car_detected,command_hook=processCommand,preview_hook=preview_available,logger_hook=logMessage,show_preview=False,queue_depth_hook=queueDepths)
             running=False
             if not exitProgram:
                 notRunningEvent.wait()
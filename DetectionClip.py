@@ -0,0 +1,158 @@
+from concurrent.futures import Executor
+from typing import Callable, Dict, List, Tuple, Union
+from pathlib import PurePosixPath
+from zipfile import ZipFile
+import argparse
+import json
+import os
+import re
+import tempfile
+import cv2
+import numpy as np
+
+# more compact ways of storing a detection's tracking frames in its zip than a full jpg per frame,
+# and reading them back as full frames for the server and for replay
+
+MANIFEST = 'clip.json'
+
+class ClipOptions(object):
+    # payload is 'jpeg' (a jpg per frame, as always), 'avi' (one MJPEG avi) or 'roi' (one background
+    # jpg plus a jpg of the part of each frame around the vehicle). keyframes > 0 keeps only that many
+    # frames, spread evenly and always including the first and last. area is the monitored area as
+    # (x,y,w,h) in image pixels and pixel_scale the detection pixels to each image pixel, the roi
+    # payload needs them to find the vehicle
+    PAYLOADS = ('jpeg','avi','roi')
+    # pixels kept around the vehicle
+    ROI_MARGIN = 16
+
+    def __init__(self,payload: str='jpeg',keyframes: int=0,area: Union[Tuple[int,int,int,int],None]=None,pixel_scale: float=1.0):
+        if not payload in ClipOptions.PAYLOADS:
+            raise ValueError(f"Unknown detection payload [{payload}]")
+        self.payload = payload
+        self.keyframes = keyframes
+        self.area = area
+        self.pixel_scale = pixel_scale
+
+def select_keyframes(count: int,keyframes: int)->List[int]:
+    # indices of the frames to keep
+    if keyframes <= 0 or keyframes >= count:
+        return list(range(count))
+    keyframes = max(2,keyframes)
+    return sorted(set(int(round(i*(count-1)/(keyframes-1))) for i in range(keyframes)))
+
+def encode_jpg(image: np.ndarray)->bytes:
+    return cv2.imencode('.jpg', image)[1].tobytes()
+
+def decode_jpg(data: bytes)->Union[np.ndarray,None]:
+    return cv2.imdecode(np.frombuffer(data,dtype=np.uint8),cv2.IMREAD_COLOR)
+
+def encode_frames(tracking_data: list,options: ClipOptions,executor: Union[Executor,None]=None,\
+                  encode: Callable[[np.ndarray],bytes]=encode_jpg)->Dict[str,bytes]:
+    # zip member names (relative to the detection's folder) and their contents
+    indices = select_keyframes(len(tracking_data),options.keyframes)
+    if not indices:
+        return {}
+    images = [tracking_data[i].image for i in indices]
+    encode_all = (lambda images: list(executor.map(encode,images))) if executor else (lambda images: [encode(image) for image in images])
+    if options.payload == 'avi':
+        return _encode_avi(images,indices)
+    if options.payload == 'roi':
+        rects = [_roi_rect(tracking_data[i],images[0].shape,options) for i in indices]
+        background = _background(images[0],images[-1],rects[0],rects[-1])
+        jpgs = encode_all([background] + [image[y:y+h,x:x+w] for (image,(x,y,w,h)) in zip(images,rects)])
+        members = {f"roi/{i}.jpg": jpg for (i,jpg) in zip(indices,jpgs[1:])}
+        members['background.jpg'] = jpgs[0]
+        members[MANIFEST] = json.dumps({'payload': 'roi', 'background': 'background.jpg',
+                                        'frames': [{'index': i, 'file': f"roi/{i}.jpg", 'rect': list(rect)} for (i,rect) in zip(indices,rects)]}).encode()
+        return members
+    # same names as always so the server reads them as before, gaps show which were left out
+    return {f"{i}.jpg": jpg for (i,jpg) in zip(indices,encode_all(images))}
+
+def read_frames(myzip: ZipFile)->List[Tuple[int,np.ndarray]]:
+    # (tracking data index, full frame) for every frame a detection zip has, whatever its payload
+    names = myzip.namelist()
+    manifests = [n for n in names if PurePosixPath(n).name == MANIFEST]
+    if not manifests:
+        jpgs = [n for n in names if re.fullmatch(r'\d+\.jpg',PurePosixPath(n).name)]
+        frames = [(int(PurePosixPath(n).stem),decode_jpg(myzip.read(n))) for n in jpgs]
+        return sorted([(i,image) for (i,image) in frames if image is not None],key=lambda f: f[0])
+    folder = PurePosixPath(manifests[0]).parent
+    manifest = json.loads(myzip.read(manifests[0]))
+    if manifest['payload'] == 'avi':
+        return _read_avi(myzip.read((folder / manifest['file']).as_posix()),manifest['frames'])
+    background = decode_jpg(myzip.read((folder / manifest['background']).as_posix()))
+    frames = []
+    for f in manifest['frames']:
+        (x,y,w,h) = f['rect']
+        crop = decode_jpg(myzip.read((folder / f['file']).as_posix()))
+        image = background.copy()
+        image[y:y+h,x:x+w] = crop
+        frames.append((f['index'],image))
+    return frames
+
+def _roi_rect(td,shape: Tuple[int,...],options: ClipOptions)->Tuple[int,int,int,int]:
+    # the strip of the monitored area the vehicle is in, tracking positions are detection pixels
+    (height,width) = shape[:2]
+    if options.area is None:
+        return (0,0,width,height)
+    (ax,ay,aw,ah) = options.area
+    margin = ClipOptions.ROI_MARGIN
+    x0 = max(0,int(ax + td.x/options.pixel_scale) - margin)
+    x1 = min(width,int(ax + (td.x+td.width)/options.pixel_scale) + margin)
+    y0 = max(0,ay - margin)
+    y1 = min(height,ay + ah + margin)
+    return (x0,y0,max(1,x1-x0),max(1,y1-y0))
+
+def _background(first: np.ndarray,last: np.ndarray,first_rect: Tuple[int,int,int,int],last_rect: Tuple[int,int,int,int])->np.ndarray:
+    # the first frame with the vehicle painted out using the last one, where it has moved on.
+    # Unless it hasn't moved clear, then the ghost of it stays
+    background = first.copy()
+    (x,y,w,h) = first_rect
+    (lx,_,lw,_) = last_rect
+    if x+w <= lx or lx+lw <= x:
+        background[y:y+h,x:x+w] = last[y:y+h,x:x+w]
+    return background
+
+def _encode_avi(images: List[np.ndarray],indices: List[int])->Dict[str,bytes]:
+    # VideoWriter only writes to files
+    (height,width) = images[0].shape[:2]
+    with tempfile.TemporaryDirectory() as folder:
+        filename = os.path.join(folder,'clip.avi')
+        writer = cv2.VideoWriter(filename,cv2.VideoWriter_fourcc(*'MJPG'),30,(width,height))
+        if not writer.isOpened():
+            raise RuntimeError("Unable to write MJPEG avi")
+        for image in images:
+            writer.write(image)
+        writer.release()
+        with open(filename,'rb') as f:
+            data = f.read()
+    # frames are timed from the tracking data, the avi's own frame rate means nothing
+    return {'clip.avi': data, MANIFEST: json.dumps({'payload': 'avi', 'file': 'clip.avi', 'frames': indices}).encode()}
+
+def _read_avi(data: bytes,indices: List[int])->List[Tuple[int,np.ndarray]]:
+    frames = []
+    with tempfile.TemporaryDirectory() as folder:
+        filename = os.path.join(folder,'clip.avi')
+        with open(filename,'wb') as f:
+            f.write(data)
+        capture = cv2.VideoCapture(filename)
+        try:
+            for index in indices:
+                (ok,image) = capture.read()
+                if not ok:
+                    break
+                frames.append((index,image))
+        finally:
+            capture.release()
+    return frames
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Extracts the tracking frames of a detection zip as numbered jpgs")
+    ap.add_argument("zipfile", help="Detection zip")
+    ap.add_argument("folder", help="Folder to write the frames to")
+    args = vars(ap.parse_args())
+
+    os.makedirs(args["folder"],exist_ok=True)
+    with ZipFile(args["zipfile"]) as myzip:
+        for (index,image) in read_frames(myzip):
+            cv2.imwrite(os.path.join(args["folder"],f"{index}.jpg"),image)
@@ -0,0 +1,66 @@
+from multiprocessing import Queue
+from multiprocessing import shared_memory
+from typing import List, Tuple, Union
+import collections
+import queue
+import numpy as np
+
+class FrameDescriptor(object):
+    # what crosses the process boundary instead of the pixels
+    def __init__(self,slot: int,shape: Tuple[int,...],dtype: str,timestamp: float=0):
+        self.slot = slot
+        self.shape = shape
+        self.dtype = dtype
+        self.timestamp = timestamp
+
+class SharedFrameRing(object):
+    # fixed number of frame sized slots in shared memory. The process that creates the ring writes
+    # frames into free slots and the process it is passed to reads them and hands the slots back
+    def __init__(self,slots: int,slot_size: int):
+        self.slots = slots
+        self.slot_size = slot_size
+        self._shm = shared_memory.SharedMemory(create=True,size=slots*slot_size)
+        # slots handed back by the reader
+        self._returned = Queue()
+        # only used by the writer
+        self._free = collections.deque(range(slots))
+        self.overflow = 0
+
+    def write(self,image: np.ndarray,timestamp: float=0)->Union[FrameDescriptor,None]:
+        # returns None if the image does not fit or no slot is free
+        self._collect_returned()
+        if not self._free or image.nbytes > self.slot_size:
+            self.overflow += 1
+            return None
+        slot = self._free.popleft()
+        np.copyto(self._view(slot,image.shape,image.dtype),image)
+        return FrameDescriptor(slot,image.shape,image.dtype.str,timestamp)
+
+    def read(self,desc: FrameDescriptor)->np.ndarray:
+        # view onto the slot, only valid until it is freed
+        return self._view(desc.slot,desc.shape,np.dtype(desc.dtype))
+
+    def free(self,descs: List[FrameDescriptor]):
+        for desc in descs:
+            if desc is not None:
+                self._returned.put(desc.slot)
+
+    def available(self)->int:
+        self._collect_returned()
+        return len(self._free)
+
+    def close(self):
+        self._shm.close()
+
+    def unlink(self):
+        self._shm.unlink()
+
+    def _view(self,slot: int,shape,dtype)->np.ndarray:
+        return np.ndarray(shape,dtype=dtype,buffer=self._shm.buf,offset=slot*self.slot_size)
+
+    def _collect_returned(self):
+        try:
+            while True:
+                self._free.append(self._returned.get_nowait())
+        except queue.Empty:
+            pass
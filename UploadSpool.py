@@ -0,0 +1,212 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, Union
+import json
+import os
+import random
+import threading
+import time
+import zipfile
+
+# detection zips waiting to go to the server. They stay where they were saved, listed in an index
+# beside them, until the server has taken them, so an outage or a restart loses nothing
+
+class SpoolEntry(object):
+    def __init__(self,path: str,added: float,attempts: int=0,next_attempt: float=0,last_error: str='',server_down: bool=False):
+        self.path = path
+        self.added = added
+        self.attempts = attempts
+        # posix time it is due to be tried again
+        self.next_attempt = next_attempt
+        self.last_error = last_error
+        # the last attempt failed because the server could not be reached, rather than it refusing the file
+        self.server_down = server_down
+
+class UploadSpool(object):
+    INDEX = 'spool.json'
+    # uploads in flight at once, only reached when catching up on a backlog
+    CONCURRENCY = 3
+    # retry delays double from BASE_DELAY up to MAX_DELAY seconds, less up to half for jitter
+    BASE_DELAY = 5
+    MAX_DELAY = 600
+
+    def __init__(self,folder: str,upload: Callable[[str],int],concurrency: int=CONCURRENCY,\
+                 base_delay: float=BASE_DELAY,max_delay: float=MAX_DELAY,log: Callable[[str],None]=print):
+        # upload posts a file and returns the http status code, raising if the server can't be reached
+        self.folder = folder
+        self.concurrency = concurrency
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.uploaded = 0
+        self.failed = 0
+        self._upload = upload
+        self._log = log
+        self._index_path = os.path.join(folder,UploadSpool.INDEX)
+        self._entries: Dict[str,SpoolEntry] = {}
+        self._in_flight = set()
+        self._cond = threading.Condition()
+        # while the server is down only one upload at a time probes it, no sooner than server_retry_at
+        self._outage_failures = 0
+        self._server_retry_at = 0.0
+        self._stopping = False
+        self._thread: Union[threading.Thread,None] = None
+        self._executor: Union[ThreadPoolExecutor,None] = None
+
+    def start(self):
+        # pick up whatever an earlier run left behind and start uploading it
+        os.makedirs(self.folder,exist_ok=True)
+        with self._cond:
+            self._rescan()
+        self._executor = ThreadPoolExecutor(self.concurrency)
+        self._thread = threading.Thread(target=self._dispatch)
+        self._thread.start()
+
+    def stop(self):
+        # only waits for the uploads in flight, the rest stay in the index for the next start
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join()
+        if self._executor:
+            self._executor.shutdown()
+        with self._cond:
+            self._save_index()
+
+    def add(self,path: str):
+        with self._cond:
+            key = str(Path(path))
+            self._entries[key] = SpoolEntry(key,time.time())
+            self._save_index()
+            self._cond.notify_all()
+
+    def pending(self)->int:
+        with self._cond:
+            return len(self._entries)
+
+    def getStatsStr(self)->str:
+        with self._cond:
+            return f"spool pending={len(self._entries)} in_flight={len(self._in_flight)} uploaded={self.uploaded} failed={self.failed}"\
+                   + (f" server down for {self._outage_failures} attempts" if self._outage_failures else "")
+
+    def retry_delay(self,attempts: int)->float:
+        delay = min(self.max_delay,self.base_delay*2**(attempts-1))
+        return delay*random.uniform(0.5,1.0)
+
+    def _rescan(self):
+        index: Dict[str,SpoolEntry] = {}
+        try:
+            with open(self._index_path) as f:
+                index = {e['path']: SpoolEntry(**e) for e in json.load(f)}
+        except FileNotFoundError:
+            pass
+        except (OSError,ValueError,TypeError,KeyError) as e:
+            self._log(f"Spool index [{self._index_path}] unreadable, rebuilding it [{e}]")
+        now = time.time()
+        for path in Path(self.folder).glob('*/*.zip.part'):
+            # partly written when the client stopped
+            path.unlink(missing_ok=True)
+        for path in sorted(Path(self.folder).glob('*/*.zip')):
+            key = str(path)
+            if not zipfile.is_zipfile(path):
+                self._log(f"Not spooling [{key}], it is not a complete zip")
+                continue
+            entry = index.get(key) or SpoolEntry(key,path.stat().st_mtime)
+            # the server may well be back so everything is due straight away
+            entry.next_attempt = now
+            entry.server_down = False
+            self._entries[key] = entry
+        self._save_index()
+        if self._entries:
+            self._log(f"Spool has {len(self._entries)} detections left to upload")
+
+    def _save_index(self):
+        # written to the side and renamed so a crash leaves the old index or the new one
+        temp = self._index_path + '.tmp'
+        with open(temp,'w') as f:
+            json.dump([e.__dict__ for e in self._entries.values()],f,indent=4)
+        os.replace(temp,self._index_path)
+
+    def _dispatch(self):
+        with self._cond:
+            while not self._stopping:
+                now = time.time()
+                if self._outage_failures:
+                    # one upload at a time probes the server until it answers again
+                    slots = 0 if self._in_flight or now < self._server_retry_at else 1
+                else:
+                    slots = self.concurrency - len(self._in_flight)
+                due = sorted((e for e in self._entries.values() if not e.path in self._in_flight and e.next_attempt <= now),key=lambda e: e.added)
+                for entry in due[:slots]:
+                    self._in_flight.add(entry.path)
+                    self._executor.submit(self._attempt,entry)
+                self._cond.wait(self._wait_secs(now))
+
+    def _wait_secs(self,now: float)->Union[float,None]:
+        # until the next upload could start, None to wait for one to finish or be added
+        due = [e.next_attempt for e in self._entries.values() if not e.path in self._in_flight]
+        if not due:
+            return None
+        if self._outage_failures:
+            return None if self._in_flight else max(0.0,max(self._server_retry_at,min(due))-now)
+        if len(self._in_flight) >= self.concurrency:
+            return None
+        return max(0.0,min(due)-now)
+
+    def _attempt(self,entry: SpoolEntry):
+        start = time.monotonic()
+        status: Union[int,None] = None
+        error = ''
+        missing = False
+        try:
+            status = self._upload(entry.path)
+        except FileNotFoundError:
+            missing = True
+        except Exception as e:
+            error = str(e) or type(e).__name__
+        secs = time.monotonic() - start
+        with self._cond:
+            self._in_flight.discard(entry.path)
+            if missing:
+                self._entries.pop(entry.path,None)
+                self._log(f"Dropping [{entry.path}] from the upload spool, the file has gone")
+            elif status == 200:
+                self._uploaded(entry,secs)
+            else:
+                self._retry_later(entry,error or f"status code {status}",status)
+            self._save_index()
+            self._cond.notify_all()
+
+    def _uploaded(self,entry: SpoolEntry,secs: float):
+        self._entries.pop(entry.path,None)
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+        self.uploaded += 1
+        self._log(f"UPLOAD: [{entry.path}] uploaded in {secs:.3f}s after {entry.attempts} retries, {len(self._entries)} left to upload")
+        if self._outage_failures:
+            # the server is back, let the backlog go at full concurrency
+            self._outage_failures = 0
+            now = time.time()
+            for e in self._entries.values():
+                if e.server_down:
+                    e.next_attempt = now
+                    e.server_down = False
+
+    def _retry_later(self,entry: SpoolEntry,error: str,status: Union[int,None]):
+        # a 4xx (bar timeouts and throttling) is the server refusing this file, anything else is the
+        # server not being there and holds back the whole spool
+        refused = status is not None and 400 <= status < 500 and not status in (408,429)
+        now = time.time()
+        entry.attempts += 1
+        entry.last_error = error
+        entry.server_down = not refused
+        entry.next_attempt = now + self.retry_delay(entry.attempts)
+        self.failed += 1
+        if not refused:
+            self._outage_failures += 1
+            self._server_retry_at = now + self.retry_delay(self._outage_failures)
+            entry.next_attempt = max(entry.next_attempt,self._server_retry_at)
+        self._log(f"Problem uploading detection [{entry.path}] [{error}], attempt {entry.attempts}, "\
+                  f"retrying in {entry.next_attempt-now:.0f}s")
@@ -10,7 +10,7 @@ else
     echo "Usage: bash deploy.sh [-p|-d]"
     exit 1
 fi
-files=("SignalRHandler.py" "SignalRTest.py" "CarSpeed_client.py" "CameraTest.py" "Legacy\ versions/carspeed_version_3\ (picamera2).py" "CarSpeed.py" "CarSpeedConfig.py" "CarSpeedMonitor.py" "CarSpeedConfigureMonitorArea.py" "CarSpeed_configure.py" "CarSpeed_configure_area.py")
+files=("SignalRHandler.py" "SignalRTest.py" "CarSpeed_client.py" "CameraTest.py" "Legacy\ versions/carspeed_version_3\ (picamera2).py" "CarSpeed.py" "CarSpeedConfig.py" "CarSpeedMonitor.py" "SharedFrameRing.py" "CarSpeedReplay.py" "CarSpeedSynthetic.py" "CarSpeedBenchmark.py" "CarSpeedStageBenchmark.py" "DetectionClip.py" "UploadSpool.py" "CarSpeedConfigureMonitorArea.py" "CarSpeed_configure.py" "CarSpeed_configure_area.py")
 cmd=""
 for file in "${files[@]}"
 do